@@ -2,6 +2,41 @@ import pyodbc
 import pandas as pd
 from config import SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER, DSN
 from datetime import datetime
+from dwh import BulkWriter, date_key
+
+# Season for each month number
+SEASONS = {
+    1: 'Winter', 2: 'Winter', 3: 'Spring', 4: 'Spring', 5: 'Spring', 6: 'Summer',
+    7: 'Summer', 8: 'Summer', 9: 'Autumn', 10: 'Autumn', 11: 'Autumn', 12: 'Winter',
+}
+
+def drop_identity_dim_date(cursor_dwh, table_name='dimDay'):
+    """
+    Drops a 'dimDay' table left by the old layout, where day_SK was an IDENTITY counter instead of
+    the yyyymmdd key, so it gets recreated. Fails when a fact table still references it, since its
+    rows carry the old keys and have to be reloaded as well.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        table_name (str, optional): The name of the table (default is 'dimDay').
+    Raises:
+        RuntimeError: When the old table is still referenced by a foreign key.
+    """
+    cursor_dwh.execute("SELECT COLUMNPROPERTY(OBJECT_ID(?), 'day_SK', 'IsIdentity')", table_name)
+    if cursor_dwh.fetchone()[0] != 1:
+        return
+
+    cursor_dwh.execute("SELECT OBJECT_NAME(parent_object_id) FROM sys.foreign_keys "
+                       "WHERE referenced_object_id = OBJECT_ID(?)", table_name)
+    referencing = [row[0] for row in cursor_dwh.fetchall()]
+    if referencing:
+        raise RuntimeError(f"'{table_name}' still uses an IDENTITY day_SK and is referenced by "
+                           f"{', '.join(referencing)}. Drop those tables, rerun dimDay.py and reload "
+                           f"them with FactTreasureFound.py --full-reload.")
+
+    print(f"Table '{table_name}' uses an IDENTITY day_SK. Dropping it to recreate it with yyyymmdd keys...")
+    cursor_dwh.execute(f"DROP TABLE {table_name}")
+    cursor_dwh.commit()
+
 
 def fill_table_dim_date_test(cursor_dwh, start_date, end_date='2040-01-01', table_name='dimDay'):
     """
@@ -22,8 +57,8 @@ def fill_table_dim_date_test(cursor_dwh, start_date, end_date='2040-01-01', tabl
             # Create the table with appropriate data types
             create_table_query = f"""
             CREATE TABLE {table_name} (
-                [day_SK] INT IDENTITY(1,1) PRIMARY KEY,
-                [Date] DATE,
+                [day_SK] INT NOT NULL PRIMARY KEY,  -- yyyymmdd
+                [Date] DATE NOT NULL UNIQUE,
                 [DayOfMonth] INT,
                 [Month] INT,
                 [Year] INT,
@@ -50,6 +85,30 @@ def fetch_min_log_time(cursor_op):
     cursor_op.execute("SELECT MIN(log_time) FROM treasure_log WHERE log_type = 2")
     return cursor_op.fetchone()[0]
 
+def build_calendar(start_date, end_date):
+    """
+    Builds the date-related attributes for every day between two dates as whole columns.
+    Args:
+        start_date (str): The first date of the calendar.
+        end_date (str): The last date of the calendar (inclusive).
+    Returns:
+        pd.DataFrame: One row per day, with the columns of the 'dimDay' table.
+    """
+    dates = pd.date_range(pd.to_datetime(start_date).normalize(), pd.to_datetime(end_date).normalize(), freq='D')
+    return pd.DataFrame({
+        'day_SK': date_key(dates),
+        'Date': dates.date,
+        'DayOfMonth': dates.day,
+        'Month': dates.month,
+        'Year': dates.year,
+        'DayOfWeek': dates.dayofweek,
+        'DayOfYear': dates.dayofyear,
+        'Weekday': dates.day_name(),
+        'MonthName': dates.month_name(),
+        'Season': dates.month.map(SEASONS),
+    })
+
+
 def fill_table_dim_date(cursor_dwh, start_date, end_date='2040-01-01', table_name='dimDay'):
     """
     Fills the 'dimDay' table with date-related data.
@@ -59,30 +118,58 @@ def fill_table_dim_date(cursor_dwh, start_date, end_date='2040-01-01', table_nam
         end_date (str): The end date for filling the table (default is '2040-01-01').
         table_name (str): The name of the table (default is 'dimDay').
     """
-    insert_query = f"""
-    INSERT INTO {table_name} ([Date], [DayOfMonth], [Month], [Year], [DayOfWeek], [DayOfYear], [Weekday], [MonthName], [Season])
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    calendar = build_calendar(start_date, end_date)
+
+    # Send the days in large parameter arrays and commit once at the end
+    with BulkWriter(cursor_dwh, table_name, calendar.columns) as writer:
+        writer.write_frame(calendar)
+
+
+def fetch_dim_date_range(cursor_dwh, table_name='dimDay'):
+    """
+    Fetches the first and last date already loaded in the 'dimDay' table.
+    Args:
+        cursor_dwh: The cursor object for the 'catchem_dwh' database.
+        table_name (str): The name of the table (default is 'dimDay').
+    Returns:
+        tuple: The minimum and maximum date, both None when the table is empty.
+    """
+    cursor_dwh.execute(f"SELECT MIN([Date]), MAX([Date]) FROM {table_name}")
+    return tuple(cursor_dwh.fetchone())
+
+
+def extend_table_dim_date(cursor_dwh, start_date, end_date='2040-01-01', table_name='dimDay'):
+    """
+    Adds only the days that are missing before the first or after the last loaded date,
+    so rerunning it over an already loaded range inserts nothing.
+    Args:
+        cursor_dwh: The cursor object for the 'catchem_dwh' database.
+        start_date (str): The start date the table should cover.
+        end_date (str): The end date the table should cover (default is '2040-01-01').
+        table_name (str): The name of the table (default is 'dimDay').
     """
-    current_date = pd.to_datetime(start_date)
-    end_date = pd.to_datetime(end_date)
-    while current_date <= end_date:
-        day_of_month = current_date.day
-        month = current_date.month
-        year = current_date.year
-        day_of_week = current_date.dayofweek
-        day_of_year = current_date.timetuple().tm_yday
-        weekday = current_date.strftime('%A')
-        month_name = current_date.strftime('%B')
-        season = get_season(current_date)  # Get the season based on the date
+    start_date = pd.to_datetime(start_date).normalize()
+    end_date = pd.to_datetime(end_date).normalize()
+    min_date, max_date = fetch_dim_date_range(cursor_dwh, table_name)
+
+    if min_date is None:
+        fill_table_dim_date(cursor_dwh, start_date, end_date, table_name)
+        return
+
+    min_date = pd.to_datetime(min_date)
+    max_date = pd.to_datetime(max_date)
+    one_day = pd.Timedelta(days=1)
+
+    # Backfill days older than the table, e.g. when treasure_log received older data
+    if start_date < min_date:
+        fill_table_dim_date(cursor_dwh, start_date, min_date - one_day, table_name)
 
-        # Execute the INSERT query
-        cursor_dwh.execute(insert_query, (
-            current_date, day_of_month, month, year, day_of_week, day_of_year, weekday, month_name, season
-        ))
+    # Extend the table towards the requested end date
+    if end_date > max_date:
+        fill_table_dim_date(cursor_dwh, max_date + one_day, end_date, table_name)
 
-        # Commit the transaction
-        cursor_dwh.commit()
-        current_date += pd.Timedelta(days=1)
+    if start_date >= min_date and end_date <= max_date:
+        print(f"'{table_name}' already covers {start_date.date()} to {end_date.date()}, nothing to add.")
 
 
 def get_season(date):
@@ -93,15 +180,7 @@ def get_season(date):
     Returns:
         str: The season (Spring, Summer, Autumn, Winter).
     """
-    month = date.month
-    if 3 <= month <= 5:
-        return 'Spring'
-    elif 6 <= month <= 8:
-        return 'Summer'
-    elif 9 <= month <= 11:
-        return 'Autumn'
-    else:
-        return 'Winter'
+    return SEASONS[date.month]
 
 def main():
     try:
@@ -117,11 +196,12 @@ def main():
         start_time = fetch_min_log_time(cursor_op)
         print(f"Minimum Log Time: {start_time}")
 
-        # Fill table dimDay
+        # Drop a dimDay of the old IDENTITY layout, then create table dimDay if it doesn't exist
+        drop_identity_dim_date(cursor_dwh, 'dimDay')
         fill_table_dim_date_test(cursor_dwh, start_time, '2100-01-01', 'dimDay')
 
-        # Fill the 'dimDay' table
-        fill_table_dim_date(cursor_dwh, start_time, '2100-01-01', 'dimDay')
+        # Add the missing days to the 'dimDay' table
+        extend_table_dim_date(cursor_dwh, start_time, '2100-01-01', 'dimDay')
 
         # Close the connections
         cursor_op.close()
@@ -0,0 +1,91 @@
+import pyodbc
+
+from config import SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER
+from dwh import establish_connection
+
+
+def get_day_part(hour):
+    """
+    Returns the part of the day an hour belongs to.
+    Args:
+        hour (int): The hour of the day (0-23).
+    Returns:
+        str: The day part (Night, Morning, Afternoon, Evening).
+    """
+    if hour < 6:
+        return 'Night'
+    elif hour < 12:
+        return 'Morning'
+    elif hour < 18:
+        return 'Afternoon'
+    else:
+        return 'Evening'
+
+
+def create_dim_hour_table(cursor_dwh, table_name='dimHour'):
+    """
+    Creates the 'dimHour' table if it doesn't exist. The key is the hour of the day itself,
+    so fact loaders can compute it from a timestamp without a lookup.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        table_name (str, optional): The name of the table (default is 'dimHour').
+    """
+    try:
+        cursor_dwh.execute(f"""
+        IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '{table_name}')
+        BEGIN
+            CREATE TABLE {table_name} (
+                [hour_SK] INT NOT NULL PRIMARY KEY,  -- 0-23
+                [Hour] INT NOT NULL,
+                [HourLabel] NVARCHAR(5) NOT NULL,
+                [DayPart] NVARCHAR(10) NOT NULL
+            )
+        END
+        """)
+        cursor_dwh.commit()
+        print(f"Table '{table_name}' created successfully or already exists")
+    except pyodbc.Error as e:
+        print(f"Error creating table '{table_name}': {e}")
+
+
+def fill_table_dim_hour(cursor_dwh, table_name='dimHour'):
+    """
+    Fills the 'dimHour' table with the 24 hours of the day in a single statement.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        table_name (str, optional): The name of the table (default is 'dimHour').
+    """
+    values = ",\n".join(
+        f"({hour}, {hour}, '{hour:02d}:00', '{get_day_part(hour)}')" for hour in range(24)
+    )
+    try:
+        cursor_dwh.execute(f"""
+        IF NOT EXISTS (SELECT * FROM {table_name})
+        BEGIN
+            INSERT INTO {table_name} ([hour_SK], [Hour], [HourLabel], [DayPart]) VALUES
+            {values}
+        END
+        """)
+        cursor_dwh.commit()
+        print(f"Hours inserted into '{table_name}' table successfully.")
+    except pyodbc.Error as e:
+        print(f"Error inserting into '{table_name}' table: {e}")
+
+
+def main():
+    try:
+        conn_dwh = establish_connection(SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER)
+        cursor_dwh = conn_dwh.cursor()
+
+        create_dim_hour_table(cursor_dwh)
+        fill_table_dim_hour(cursor_dwh)
+
+        cursor_dwh.close()
+        conn_dwh.close()
+
+    except pyodbc.Error as e:
+        print(f"Error connecting to the database: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
+import sys
+
 import pyodbc
 import pandas as pd
 
 from config import SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER, DSN
-from dwh import establish_connection
+from dwh import TREASURE_TYPE_RANGES, establish_connection
 
 def create_dim_treasure_type_table(conn):
     """
@@ -15,7 +17,7 @@ def create_dim_treasure_type_table(conn):
         IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'dimTreasureType')
         BEGIN
             CREATE TABLE dimTreasureType (
-                treasureType_SK INT IDENTITY(1,1) PRIMARY KEY,
+                treasureType_SK INT NOT NULL PRIMARY KEY,  -- computed, see dwh.treasure_type_key
                 difficulty INT NOT NULL,
                 terrain INT NOT NULL,
                 size INT NOT NULL,
@@ -28,90 +30,90 @@ def create_dim_treasure_type_table(conn):
     except pyodbc.Error as e:
         print(f"Error creating table 'dimTreasureType': {e}")
 
+def treasure_type_key_sql():
+    """
+    Builds the SQL expression of dwh.treasure_type_key over the columns of the value lists
+    used by fill_dim_treasure_type_table.
+    Returns:
+        str: The mixed-radix key expression.
+    """
+    key = "0"
+    for column, values in TREASURE_TYPE_RANGES.items():
+        key = f"({key}) * {len(values)} + ({column}.v - {values.start})"
+    return f"{key} + 1"
+
+
 def fill_dim_treasure_type_table(cursor):
     """
-    Fills the 'dimTreasureType' table with all possible combinations.
+    Fills the 'dimTreasureType' table with all possible combinations in one statement:
+    the Cartesian product of the value ranges in dwh.TREASURE_TYPE_RANGES, keyed by the
+    same mixed-radix key the fact load computes. Runs only when the table is empty.
     Args:
         cursor (pyodbc.Cursor): Cursor object for executing SQL commands.
     """
+    value_lists = "\n            CROSS JOIN ".join(
+        "(VALUES {}) AS {}(v)".format(", ".join(f"({value})" for value in values), column)
+        for column, values in TREASURE_TYPE_RANGES.items()
+    )
+    columns = ", ".join(TREASURE_TYPE_RANGES)
+    values = ", ".join(f"{column}.v" for column in TREASURE_TYPE_RANGES)
     try:
-        for difficulty in range(5):  # Assuming 0-4 range for difficulty
-            for terrain in range(5):  # Assuming 0-4 range for terrain
-                for size in range(1, 4):  # Assuming 1-3 range for size
-                    for visibility in range(3):  # Assuming 0-2 range for visibility
-                        insert_query = """
-                        INSERT INTO dimTreasureType (difficulty, terrain, size, visibility)
-                        VALUES (?, ?, ?, ?)
-                        """
-                        cursor.execute(insert_query, (difficulty, terrain, size, visibility))
-
+        cursor.execute(f"""
+        IF NOT EXISTS (SELECT * FROM dimTreasureType)
+        BEGIN
+            INSERT INTO dimTreasureType (treasureType_SK, {columns})
+            SELECT {treasure_type_key_sql()}, {values}
+            FROM {value_lists}
+        END
+        """)
         cursor.commit()
         print("Treasure types inserted into 'dimTreasureType' table successfully.")
     except pyodbc.Error as e:
         print(f"Error inserting into 'dimTreasureType' table: {e}")
 
-def analyze_execution_plan(cursor, query):
+def create_indexed_view(cursor):
     """
-    Analyze the execution plan of a given query using SET SHOWPLAN_ALL.
+    Creates the indexed view vw_DimTreasureType_Indexed if it doesn't exist yet
+    (python dimTreasureType.py --indexed-view). Decide on it with the query benchmark:
+    run queries/benchmark_queries.py before and after creating it and compare the two runs.
     Args:
         cursor (pyodbc.Cursor): Cursor object for executing SQL commands.
-        query (str): SQL query to be analyzed.
     """
-    try:
-        # Enable execution plan display
-        cursor.execute("SET SHOWPLAN_ALL ON")
-
-        # Execute the query (this will not return actual results but will provide the execution plan)
-        cursor.execute(query)
-
-        # Fetch and print the execution plan
-        print("Execution Plan:")
-        for row in cursor.fetchall():
-            print(row)
-
-        # Disable execution plan display
-        cursor.execute("SET SHOWPLAN_ALL OFF")
-    except pyodbc.Error as e:
-        print(f"Error analyzing execution plan: {e}")
-
-
-def create_indexed_view(cursor):
     try:
         # Step 1: Verify SET options
         cursor.execute("SET NUMERIC_ROUNDABORT OFF")
         cursor.execute("SET ANSI_PADDING, ANSI_WARNINGS, CONCAT_NULL_YIELDS_NULL, ARITHABORT, QUOTED_IDENTIFIER, ANSI_NULLS ON")
 
-        # Step 2: Drop the index if it exists
-        cursor.execute("""
-            IF EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_DimTreasureType_Indexed' AND object_id = OBJECT_ID('vw_DimTreasureType_Indexed'))
-            BEGIN
-                DROP INDEX IX_DimTreasureType_Indexed ON vw_DimTreasureType_Indexed;
-            END
-        """)
-
-        # Step 3: Create the view with SCHEMABINDING
+        # Step 2: Create the view with SCHEMABINDING, CREATE VIEW has to be alone in its batch
         cursor.execute("""
-            CREATE VIEW vw_DimTreasureType_Indexed
-            WITH SCHEMABINDING
-            AS
-            SELECT 
-                difficulty,
-                terrain,
-                COUNT_BIG(*) AS size,
-                SUM(ISNULL(CAST(visibility AS FLOAT), 0)) AS total_visibility
-            FROM 
-                dbo.dimTreasureType
-            GROUP BY 
-                difficulty, terrain;
+            IF OBJECT_ID('vw_DimTreasureType_Indexed', 'V') IS NULL
+                EXEC('
+                CREATE VIEW vw_DimTreasureType_Indexed
+                WITH SCHEMABINDING
+                AS
+                SELECT
+                    difficulty,
+                    terrain,
+                    COUNT_BIG(*) AS size,
+                    SUM(ISNULL(CAST(visibility AS FLOAT), 0)) AS total_visibility
+                FROM
+                    dbo.dimTreasureType
+                GROUP BY
+                    difficulty, terrain
+                ')
         """)
 
-        # Step 4: Create the unique clustered index on the view
+        # Step 3: Create the unique clustered index on the view
         cursor.execute("""
-            CREATE UNIQUE CLUSTERED INDEX IX_DimTreasureType_Indexed 
-            ON vw_DimTreasureType_Indexed (difficulty, terrain);
+            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_DimTreasureType_Indexed' AND object_id = OBJECT_ID('vw_DimTreasureType_Indexed'))
+            BEGIN
+                CREATE UNIQUE CLUSTERED INDEX IX_DimTreasureType_Indexed
+                ON vw_DimTreasureType_Indexed (difficulty, terrain);
+            END
         """)
+        cursor.commit()
 
-        print("Indexed view created successfully.")
+        print("Indexed view created successfully or already exists.")
     except pyodbc.Error as e:
         print(f"Error creating indexed view: {e}")
 
@@ -128,17 +130,9 @@ def main():
         # Step 2: Fill dimTreasureType table with all possible combinations
         fill_dim_treasure_type_table(cursor)
 
-        # Step 3: Analyze the original execution plan
-        sample_query = "SELECT * FROM dimTreasureType WHERE difficulty = 0 AND terrain = 0"
-        analyze_execution_plan(cursor, sample_query)
-
-        # Step 4: Create the indexed view
-        create_indexed_view(cursor)
-
-        # Step 5: Analyze execution plan after implementing the indexed view
-        analyze_execution_plan(cursor, sample_query)
-
-        # Step 6: Decide whether to implement the indexed view (manual decision)
+        # Step 3: Create the indexed view only when asked for, see create_indexed_view
+        if '--indexed-view' in sys.argv:
+            create_indexed_view(cursor)
 
         # Close cursor and connection
         cursor.close()
@@ -1,52 +1,94 @@
 
+import sys
 from datetime import datetime
 import pyodbc
 
 from config import SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER, DSN
-from dwh import establish_connection
-
-user_query = """
+from dwh import (BulkWriter, establish_connection, iter_frames, row_hash, create_watermark_table,
+                 get_change_version, set_change_version)
+from user_activity import create_user_activity_table, refresh_user_activity
+
+# Find count, first find and dedicator status come from the maintained user_activity summary
+# (see user_activity.py) instead of joining the whole treasure_log and treasure history.
+# {user_filter} narrows the query down to some users, see changed_user_query
+USER_QUERY_TEMPLATE = """
 SELECT
-    userId, first_name, last_name,
-    CONCAT(number,' ', street,' ', city_name,' ', country_name) AS address,
-    found_logs_no,
-    earliest_log_date,
-    experience_level,
-    is_dedicator
+    u.id AS userId,
+    u.first_name,
+    u.last_name,
+    CONCAT(u.number,' ', u.street,' ', c.city_name,' ', co.name) AS address,
+    a.found_count AS found_logs_no,
+    a.first_find AS earliest_log_date,
+    CASE
+        WHEN a.found_count = 0 THEN 'Starter'
+        WHEN a.found_count < 4 THEN 'Amateur'
+        WHEN a.found_count BETWEEN 4 AND 10 THEN 'Professional'
+        ELSE 'Pirate'
+    END AS experience_level,
+    CASE WHEN a.owns_treasure = 1 THEN 'Yes' ELSE 'No' END AS is_dedicator
 FROM
-    (SELECT
-        u.id AS userId,
-        u.first_name,
-        u.last_name,
-        u.number,
-        u.street,
-        c.city_name,
-        co.name AS country_name,
-        COUNT(tl.id) AS found_logs_no,
-        MIN(tl.log_time) AS earliest_log_date,
-        CASE
-            WHEN COUNT(tl.id) = 0 THEN 'Starter'
-            WHEN COUNT(tl.id) < 4 THEN 'Amateur'
-            WHEN COUNT(tl.id) BETWEEN 4 AND 10 THEN 'Professional'
-            ELSE 'Pirate'
-        END AS experience_level,
-        MAX(CASE WHEN t.owner_id IS NOT NULL THEN 'Yes' ELSE 'No' END) AS is_dedicator
-    FROM
-        catchem_9_2023.dbo.user_table u
-    LEFT JOIN
-        catchem_9_2023.dbo.city c ON u.city_city_id = c.city_id
-    LEFT JOIN
-        catchem_9_2023.dbo.country co ON c.country_code = co.code
-    LEFT JOIN
-        catchem_9_2023.dbo.treasure_log tl ON u.id = tl.hunter_id
-    LEFT JOIN
-        catchem_9_2023.dbo.treasure t ON u.id = t.owner_id
-    WHERE
-        tl.log_type = 2
-    GROUP BY
-        u.id, u.first_name, u.last_name, u.number, u.street, c.city_name, co.name) AS subquery;
+    catchem_9_2023.dbo.user_table u
+JOIN
+    catchem_dwh.dbo.user_activity a ON a.userId = u.id
+LEFT JOIN
+    catchem_9_2023.dbo.city c ON u.city_city_id = c.city_id
+LEFT JOIN
+    catchem_9_2023.dbo.country co ON c.country_code = co.code
+WHERE
+    a.found_count > 0{user_filter};
+"""
+
+user_query = USER_QUERY_TEMPLATE.format(user_filter="")
+
+# The same query, only for the users collected in #changed_users by collect_changed_users
+changed_user_query = USER_QUERY_TEMPLATE.format(user_filter="""
+    AND u.id IN (SELECT userId FROM #changed_users)""")
+
+# Name of the dimUser load in the etl_watermark table
+CHANGE_SOURCE = 'dimUser'
+
+# Source tables whose changes can change a user's address, dedicator status or find count
+CHANGE_TRACKED_TABLES = ['user_table', 'city', 'treasure_log', 'treasure']
+
+# Created without parameters: a temp table created in a parameterized batch is dropped when the batch ends
+create_changed_users_query = """
+IF OBJECT_ID('tempdb..#changed_users') IS NOT NULL DROP TABLE #changed_users;
+CREATE TABLE #changed_users (userId BINARY(16) NOT NULL PRIMARY KEY);
 """
 
+changed_users_query = """
+INSERT INTO #changed_users (userId)
+SELECT DISTINCT userId
+FROM (
+    SELECT ct.id AS userId
+    FROM CHANGETABLE(CHANGES catchem_9_2023.dbo.user_table, ?) ct
+    UNION ALL
+    SELECT u.id
+    FROM CHANGETABLE(CHANGES catchem_9_2023.dbo.city, ?) ct
+    JOIN catchem_9_2023.dbo.user_table u ON u.city_city_id = ct.city_id
+    UNION ALL
+    SELECT tl.hunter_id
+    FROM CHANGETABLE(CHANGES catchem_9_2023.dbo.treasure_log, ?) ct
+    JOIN catchem_9_2023.dbo.treasure_log tl ON tl.id = ct.id
+    UNION ALL
+    SELECT t.owner_id
+    FROM CHANGETABLE(CHANGES catchem_9_2023.dbo.treasure, ?) ct
+    JOIN catchem_9_2023.dbo.treasure t ON t.id = ct.id
+) AS changes
+WHERE userId IS NOT NULL;
+"""
+
+# Columns returned by user_query
+USER_QUERY_COLUMNS = ['userId', 'first_name', 'last_name', 'address', 'found_logs_no', 'earliest_log_date',
+                      'experience_level', 'is_dedicator']
+
+# Attributes whose change opens a new dimUser version; their hash is stored in row_hash
+SCD_TRACKED_COLUMNS = ['address', 'is_dedicator']
+
+# Columns written for every dimUser version
+DIM_USER_COLUMNS = ['userId', 'first_name', 'last_name', 'address', 'experience_level', 'is_dedicator',
+                    'scd_start', 'scd_end', 'scd_version', 'scd_active', 'row_hash']
+
 # Function to create dimUser table if it doesn't exist
 def create_dimUser_table(conn):
     cursor = conn.cursor()
@@ -66,7 +108,8 @@ def create_dimUser_table(conn):
             scd_start DATETIME,
             scd_end DATETIME,
             scd_version INT,
-            scd_active BIT
+            scd_active BIT,
+            row_hash BINARY(8)
         );
     END
     """
@@ -74,90 +117,270 @@ def create_dimUser_table(conn):
     try:
         cursor.execute(create_table_query)
         conn.commit()
+        ensure_row_hash_column(cursor)
         print("dimUser table created successfully or already exists")
     except pyodbc.Error as e:
         print(f"Error creating dimUser table: {e}")
     finally:
         cursor.close()
 
+
+def ensure_row_hash_column(cursor_dwh):
+    """
+    Adds the row_hash column to a dimUser table created before it existed. Runs on every load.
+    The hashes are compared in Python by load_active_versions, so the IX_dimUser_active_hash
+    index earlier loads created is dropped: nothing reads it, and every load had to maintain it.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+    """
+    cursor_dwh.execute("""
+    IF COL_LENGTH('dimUser', 'row_hash') IS NULL
+        ALTER TABLE dimUser ADD row_hash BINARY(8);
+
+    IF EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_dimUser_active_hash' AND object_id = OBJECT_ID('dimUser'))
+        DROP INDEX IX_dimUser_active_hash ON dimUser;
+    """)
+    cursor_dwh.commit()
+
 # make sure is dedicator and address should be correct one for first run
 def insert_first_run_data(cursor_op, cursor_dwh):
     # Execute the user_query
     print("Extracting user data from cachem db...")
-    cursor_op.execute(user_query)
-    print("Query execution complete")
-    rows = cursor_op.fetchall()
+    with BulkWriter(cursor_dwh, 'dimUser', DIM_USER_COLUMNS, label='dimUser first run') as writer:
+        # Stream the source rows in bounded batches instead of fetching them all at once
+        for users in iter_frames(cursor_op, user_query, columns=USER_QUERY_COLUMNS):
+            # Everyone is 'Starter' for first run
+            users['experience_level'] = 'Starter'
 
-    for row in rows:
-        userId, first_name, last_name, address, found_logs_no, earliest_log_date, experience_level, is_dedicator  = row
+            # Everyone is set as No for first run
+            users['is_dedicator'] = 'No'
 
-        # Everyone is 'Starter' for first run
-        experience_level = 'Starter'
+            # Set SCD date as null for first run
+            users['scd_start'] = users['earliest_log_date']
+            users['scd_end'] = '2040-01-01'  # set far in the future
+            users['scd_version'] = 1
+            users['scd_active'] = 1
+            users['row_hash'] = row_hash(users, SCD_TRACKED_COLUMNS)
 
-        # Everyone is set as No for first run
-        is_dedicator = 'No'
+            # Insert record in the data warehouse
+            writer.write_frame(users)
 
-        # Set SCD date as null for first run
-        scd_start = earliest_log_date
-        scd_end = '2040-01-01'  # set far in the future
+    print("Initial insert for dimUser completed successfully")
 
-        # Insert record in the data warehouse
-        insert_query = """
-            INSERT INTO dimUser (userId, first_name, last_name, address,
-             experience_level, is_dedicator, scd_start, scd_end, scd_version, scd_active)
-            VALUES (?,?,?,?,?,?,?,?,?,?)
-        """
-        cursor_dwh.execute(insert_query, (userId, first_name, last_name, address,
-                                          experience_level, is_dedicator, scd_start, scd_end, 1, 1))
 
-        cursor_dwh.commit()
-        print("Initial insert for dimUser completed successfully")
+def load_active_versions(cursor_dwh):
+    """
+    Loads the row hash and version of the active version of every user in dimUser in one pass.
+    Versions written before row_hash existed get their hash computed from the stored attributes.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+    Returns:
+        dict: userId -> (row_hash, scd_version) of the active version.
+    """
+    active_versions = {}
+    for versions in iter_frames(cursor_dwh, """
+            SELECT userId, address, is_dedicator, scd_version, row_hash
+            FROM dimUser
+            WHERE scd_active = 1"""):
+        missing = versions['row_hash'].isna()
+        if missing.any():
+            versions.loc[missing, 'row_hash'] = row_hash(versions[missing], SCD_TRACKED_COLUMNS)
+        for userId, hash_value, scd_version in zip(versions['userId'], versions['row_hash'], versions['scd_version']):
+            active_versions[bytes(userId)] = (bytes(hash_value), scd_version)
+    return active_versions
+
+
+def expire_versions(cursor_dwh, user_ids, scd_end):
+    """
+    Closes the active version of the given users with a single set-based UPDATE.
+    The ids are bulk loaded into a temporary table first; nothing is committed.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        user_ids (list): The userIds whose active version has to be expired.
+        scd_end (datetime): The end date of the expired versions.
+    Returns:
+        int: The number of versions expired.
+    """
+    if not user_ids:
+        return 0
+    cursor_dwh.execute("""
+        IF OBJECT_ID('tempdb..#dimUser_expired') IS NOT NULL DROP TABLE #dimUser_expired;
+        CREATE TABLE #dimUser_expired (userId BINARY(16) NOT NULL PRIMARY KEY);
+    """)
+    with BulkWriter(cursor_dwh, '#dimUser_expired', ['userId'], commit_every=0,
+                    label='dimUser expired ids') as writer:
+        writer.extend((user_id,) for user_id in user_ids)
+
+    cursor_dwh.execute("""
+        UPDATE d
+        SET d.scd_end = ?, d.scd_active = 0
+        FROM dimUser d
+        JOIN #dimUser_expired e ON e.userId = d.userId
+        WHERE d.scd_active = 1
+    """, (scd_end,))
+    expired = cursor_dwh.rowcount
+    cursor_dwh.execute("DROP TABLE #dimUser_expired")
+    return expired
+
+
+def enable_change_tracking(retention_days=7):
+    """
+    Enables SQL Server Change Tracking on the operational database and on the tables
+    the dimUser aggregate reads, if it isn't enabled yet. This is a one-time setup step, not
+    part of the nightly load: run `python dimUser.py --enable-change-tracking` once as a user
+    allowed to ALTER DATABASE (or have the DBA run the same statements). ALTER DATABASE can't
+    run inside a transaction, so it uses its own autocommit connection.
+    Args:
+        retention_days (int): How long the change information is kept; a load that doesn't run
+            within this window falls back to a full extract.
+    """
+    try:
+        conn_op = establish_connection(SERVER, DATABASE_OP, USERNAME, PASSWORD, DRIVER, autocommit=True)
+    except pyodbc.Error as e:
+        print(f"Error connecting to the database: {e}")
+        return
 
+    cursor_op = conn_op.cursor()
+    try:
+        cursor_op.execute(f"""
+        IF NOT EXISTS (SELECT * FROM sys.change_tracking_databases WHERE database_id = DB_ID('{DATABASE_OP}'))
+            ALTER DATABASE [{DATABASE_OP}] SET CHANGE_TRACKING = ON
+            (CHANGE_RETENTION = {retention_days} DAYS, AUTO_CLEANUP = ON)
+        """)
+        for table in CHANGE_TRACKED_TABLES:
+            cursor_op.execute(f"""
+            IF NOT EXISTS (SELECT * FROM sys.change_tracking_tables WHERE object_id = OBJECT_ID('{table}'))
+                ALTER TABLE {table} ENABLE CHANGE_TRACKING
+            """)
+        print("Change tracking enabled successfully or already enabled")
+    except pyodbc.Error as e:
+        print(f"Error enabling change tracking: {e}")
+    finally:
+        cursor_op.close()
+        conn_op.close()
 
-def handle_dimUser_scd(cursor_op, cursor_dwh):
-    # Execute the user_query
+
+def fetch_current_change_version(cursor_op):
+    """
+    Reads the current Change Tracking version of the operational database. Read it before
+    anything the dimUser load depends on is extracted (including the user_activity refresh),
+    so changes committed meanwhile are still reported by the next run.
+    Args:
+        cursor_op (pyodbc.Cursor): The cursor object for the 'catchem' database.
+    Returns:
+        int: The current version, None when Change Tracking isn't enabled.
+    """
+    cursor_op.execute("SELECT CHANGE_TRACKING_CURRENT_VERSION()")
+    return cursor_op.fetchone()[0]
+
+
+def collect_changed_users(cursor_op, cursor_dwh, current_version):
+    """
+    Collects the users changed since the last dimUser load into #changed_users on the
+    operational connection, using Change Tracking. A user counts as changed when its row,
+    its city, one of its treasure logs or one of its treasures changed.
+    Args:
+        cursor_op (pyodbc.Cursor): The cursor object for the 'catchem' database.
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        current_version (int): The version read by fetch_current_change_version before the extract.
+    Returns:
+        tuple: The query to extract the users with (changed_user_query, or user_query when the
+            last version is missing or no longer valid) and the current change version to store,
+            None when Change Tracking isn't enabled.
+    """
+    if current_version is None:
+        print(f"Change tracking is not enabled on {DATABASE_OP} (run 'python dimUser.py --enable-change-tracking' "
+              f"once), extracting all users")
+        return user_query, None
+
+    last_version = get_change_version(cursor_dwh, CHANGE_SOURCE)
+    if last_version is None:
+        print("No change version stored for dimUser, extracting all users")
+        return user_query, current_version
+
+    for table in CHANGE_TRACKED_TABLES:
+        cursor_op.execute("SELECT CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID(?))", (table,))
+        min_valid_version = cursor_op.fetchone()[0]
+        if min_valid_version is None or last_version < min_valid_version:
+            print(f"Change information for {table} has been cleaned up, extracting all users")
+            return user_query, current_version
+
+    cursor_op.execute(create_changed_users_query)
+    cursor_op.execute(changed_users_query, (last_version,) * len(CHANGE_TRACKED_TABLES))
+    cursor_op.execute("SELECT COUNT(*) FROM #changed_users")
+    print(f"{cursor_op.fetchone()[0]} users changed since change version {last_version}")
+    return changed_user_query, current_version
+
+
+def handle_dimUser_scd(cursor_op, cursor_dwh, changed_only=False, current_version=None):
+    """
+    Applies SCD Type 2 to dimUser for the whole source extract at once. The active versions
+    are loaded into memory and diffed against the source; the expirations and the new
+    versions are then written as two bulk operations in one transaction, all stamped with
+    the same batch timestamp.
+    Args:
+        cursor_op (pyodbc.Cursor): The cursor object for the 'catchem' database.
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        changed_only (bool): Only extract the users changed since the last run, found with
+            Change Tracking (see enable_change_tracking); the reached version is stored in etl_watermark.
+        current_version (int, optional): The Change Tracking version read before user_activity was
+            refreshed (see fetch_current_change_version); read here when omitted.
+    """
+    batch_time = datetime.now()
+
+    query = user_query
+    if changed_only:
+        if current_version is None:
+            current_version = fetch_current_change_version(cursor_op)
+        query, current_version = collect_changed_users(cursor_op, cursor_dwh, current_version)
+
+    # Warehouses created before row_hash existed get the column first
+    ensure_row_hash_column(cursor_dwh)
+
+    print("Loading active dimUser versions...")
+    active_versions = load_active_versions(cursor_dwh)
+
+    # Execute the user_query and diff it against the active versions in memory;
+    # a user changed when the hash of its tracked attributes differs
     print("Extracting user data from catchem db...")
-    cursor_op.execute(user_query)
-    print("Query execution complete")
-    rows = cursor_op.fetchall()
-
-    for row in rows:
-        # Extract data from the source table
-        (userId, first_name, last_name, address,
-         found_logs_no, earliest_log_date, experience_level, is_dedicator) = row
-
-        # if user exist in dimUser already or not
-        cursor_dwh.execute("SELECT * FROM dimUser WHERE userId = ?", (userId,))
-        existing_user = cursor_dwh.fetchone()
-
-        # cursor_dwh.execute("SELECT COUNT(*) FROM dimUser WHERE userId = ?", (userId,))
-        # count = cursor_dwh.fetchone()[0]
-
-        if existing_user is None:   # if this user doesn't exist, insert it
-            cursor_dwh.execute("""INSERT INTO dimUser (userId, first_name, last_name, address,
-                         experience_level, is_dedicator, scd_start, scd_end, scd_version, scd_active)
-                        VALUES (?,?,?,?,?,?,?,?,?,?)""", (userId, first_name, last_name, address, experience_level,
-                                                                                 is_dedicator, datetime.now(), '2040-01-01', 1,1))
-            print(f"Inserted new user into dimUser", userId)
-
-        else: # user already exist, check for changes
-            existing_address = existing_user[4]
-            existing_is_dedicator = existing_user[6]
-
-            if address != existing_address or is_dedicator != existing_is_dedicator:
-                # update existing records and insert new version
-                cursor_dwh.execute("""UPDATE dimUser SET scd_end = ?, scd_active =0 
-                                        WHERE userId = ? AND scd_active = 1""", (datetime.now(), userId,))
-
-                cursor_dwh.execute("""INSERT INTO dimUser (userId, first_name, last_name, address,
-                             experience_level, is_dedicator, scd_start, scd_end, scd_version, scd_active)
-                            VALUES (?,?,?,?,?,?,?,?,?,?)""",
-                            (userId, first_name, last_name, address, experience_level, is_dedicator, datetime.now(), '2040-01-01', existing_user[9]+1, 1))
-
-                print(f"Updated user {userId} in dimUser table")
-            else:
-                print(f"No changes for user {userId}")
-    cursor_dwh.commit()
+    new_versions = []
+    expired_ids = []
+    unchanged = 0
+    # Stream the source rows in bounded batches instead of fetching them all at once
+    for users in iter_frames(cursor_op, query, columns=USER_QUERY_COLUMNS):
+        users['row_hash'] = row_hash(users, SCD_TRACKED_COLUMNS)
+        for (userId, first_name, last_name, address, experience_level, is_dedicator,
+             hash_value) in zip(users['userId'], users['first_name'], users['last_name'], users['address'],
+                                users['experience_level'], users['is_dedicator'], users['row_hash']):
+            existing_user = active_versions.get(bytes(userId))
+            if existing_user is None:   # if this user doesn't exist, insert it
+                version = 1
+            else:   # user already exist, check for changes
+                existing_hash, existing_version = existing_user
+                if hash_value == existing_hash:
+                    unchanged += 1
+                    continue
+                expired_ids.append(userId)
+                version = int(existing_version) + 1
+
+            new_versions.append((userId, first_name, last_name, address, experience_level,
+                                 is_dedicator, batch_time, '2040-01-01', version, 1, hash_value))
+
+    # Expire the changed versions and insert the new ones in one transaction
+    try:
+        expired = expire_versions(cursor_dwh, expired_ids, batch_time)
+        with BulkWriter(cursor_dwh, 'dimUser', DIM_USER_COLUMNS, commit_every=0,
+                        label='dimUser new versions') as writer:
+            writer.extend(new_versions)
+        if changed_only and current_version is not None:
+            set_change_version(cursor_dwh, CHANGE_SOURCE, current_version)
+        cursor_dwh.commit()
+    except pyodbc.Error:
+        cursor_dwh.rollback()
+        raise
+
+    print(f"dimUser: {len(new_versions) - len(expired_ids)} new users, {expired} changed users, "
+          f"{unchanged} unchanged users")
 
 
 # Function to establish connections and call the necessary functions
@@ -177,8 +400,18 @@ def main():
         # # only runs for the first time
         # insert_first_run_data(cursor_op,cursor_dwh)
 
+        # Stores the Change Tracking version reached, so that only changed users are extracted next run
+        create_watermark_table(cursor_dwh)
+
+        # Read the change version first: changes committed during the refresh are picked up next run
+        current_version = fetch_current_change_version(cursor_op)
+
+        # Add the finds logged since the last run to the user activity summary
+        create_user_activity_table(cursor_dwh)
+        refresh_user_activity(cursor_op, cursor_dwh)
+
         # Handle SCD Type 2 updates for dimUser
-        handle_dimUser_scd(cursor_op, cursor_dwh)
+        handle_dimUser_scd(cursor_op, cursor_dwh, changed_only=True, current_version=current_version)
 
     except pyodbc.Error as e:
         print(f"Error connecting to the database: {e}")
@@ -205,4 +438,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if '--enable-change-tracking' in sys.argv:
+        enable_change_tracking()
+    else:
+        main()
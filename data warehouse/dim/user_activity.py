@@ -0,0 +1,282 @@
+from datetime import timedelta
+
+import pyodbc
+
+from config import SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER
+from dwh import (BulkWriter, establish_connection, iter_batches, create_watermark_table,
+                 get_watermark, set_watermark)
+
+# Name of the user_activity refresh in the etl_watermark table
+WATERMARK_SOURCE = 'user_activity'
+
+# Finds logged up to this many hours before the watermark are read again on every refresh, so finds
+# committed late (with a log_time at or before the watermark) are still counted. The ids of the finds
+# counted within this window are kept in user_activity_seen, so none is counted twice.
+LATE_FIND_HOURS = 24
+
+# Newest find in the treasure_log
+newest_find_query = """
+SELECT MAX(log_time)
+FROM catchem_9_2023.dbo.treasure_log
+WHERE log_type = 2
+  AND hunter_id IS NOT NULL
+"""
+
+# Finds per hunter logged before a log_time, aggregated on the source (first refresh only)
+older_finds_query = """
+SELECT hunter_id, COUNT(*) AS found_count, MIN(log_time) AS first_find
+FROM catchem_9_2023.dbo.treasure_log
+WHERE log_type = 2
+  AND hunter_id IS NOT NULL
+  AND log_time < ?
+GROUP BY hunter_id
+"""
+
+# The individual finds logged from a log_time on, to be checked against user_activity_seen
+recent_finds_query = """
+SELECT id, hunter_id, log_time
+FROM catchem_9_2023.dbo.treasure_log
+WHERE log_type = 2
+  AND hunter_id IS NOT NULL
+  AND log_time >= ?
+"""
+
+owners_query = """
+SELECT DISTINCT owner_id
+FROM catchem_9_2023.dbo.treasure
+WHERE owner_id IS NOT NULL
+"""
+
+
+def create_user_activity_table(cursor_dwh):
+    """
+    Creates the 'user_activity' table, the maintained per-user summary dimUser reads its
+    find count, first find and dedicator status from, and 'user_activity_seen' with the ids
+    of the finds counted within LATE_FIND_HOURS of the watermark.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+    """
+    try:
+        cursor_dwh.execute("""
+        IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'user_activity')
+        BEGIN
+            CREATE TABLE user_activity (
+                userId BINARY(16) NOT NULL PRIMARY KEY,
+                found_count INT NOT NULL DEFAULT 0,
+                first_find DATETIME NULL,
+                owns_treasure BIT NOT NULL DEFAULT 0,
+                updated_at DATETIME2 NOT NULL DEFAULT SYSDATETIME()
+            )
+        END
+        """)
+        # A summary refreshed before this table existed counted every find up to its watermark
+        cursor_dwh.execute("""
+        IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'user_activity_seen')
+        BEGIN
+            CREATE TABLE user_activity_seen (
+                logId BINARY(16) NOT NULL PRIMARY KEY,
+                log_time DATETIME NOT NULL
+            );
+
+            INSERT INTO user_activity_seen (logId, log_time)
+            SELECT tl.id, tl.log_time
+            FROM catchem_9_2023.dbo.treasure_log AS tl
+            JOIN etl_watermark AS w ON w.source_name = ?
+            WHERE tl.log_type = 2
+              AND tl.hunter_id IS NOT NULL
+              AND tl.log_time >= DATEADD(HOUR, -?, w.high_water_mark)
+              AND tl.log_time <= w.high_water_mark;
+        END
+        """, (WATERMARK_SOURCE, LATE_FIND_HOURS))
+        cursor_dwh.commit()
+        print("user_activity table created successfully or already exists")
+    except pyodbc.Error as e:
+        print(f"Error creating user_activity table: {e}")
+
+
+def merge_all_finds(cursor_op, cursor_dwh):
+    """
+    Fills user_activity from the whole treasure_log on the first refresh. The finds logged more
+    than LATE_FIND_HOURS before the newest one are aggregated per hunter on the source, staged
+    and merged in one statement; the finds after that are added by merge_new_finds, so the ids
+    recorded in user_activity_seen come from the same rows that were counted.
+    Nothing is committed.
+    Args:
+        cursor_op (pyodbc.Cursor): The cursor object for the 'catchem' database.
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+    Returns:
+        datetime: The newest log_time merged, or None if there were no finds.
+    """
+    cursor_op.execute(newest_find_query)
+    newest = cursor_op.fetchone()[0]
+    if newest is None:
+        return None
+
+    cursor_dwh.execute("""
+        IF OBJECT_ID('tempdb..#user_activity_finds') IS NOT NULL DROP TABLE #user_activity_finds;
+        CREATE TABLE #user_activity_finds (
+            userId BINARY(16) NOT NULL PRIMARY KEY,
+            found_count INT NOT NULL,
+            first_find DATETIME NOT NULL
+        );
+    """)
+    with BulkWriter(cursor_dwh, '#user_activity_finds', ['userId', 'found_count', 'first_find'],
+                    commit_every=0, label='user_activity finds') as writer:
+        for rows in iter_batches(cursor_op, older_finds_query, (newest - timedelta(hours=LATE_FIND_HOURS),)):
+            writer.extend(tuple(row) for row in rows)
+
+    cursor_dwh.execute("""
+        MERGE user_activity AS a
+        USING #user_activity_finds AS f ON a.userId = f.userId
+        WHEN MATCHED THEN UPDATE SET
+            found_count = a.found_count + f.found_count,
+            first_find = CASE WHEN a.first_find IS NULL OR f.first_find < a.first_find
+                              THEN f.first_find ELSE a.first_find END,
+            updated_at = SYSDATETIME()
+        WHEN NOT MATCHED THEN INSERT (userId, found_count, first_find)
+            VALUES (f.userId, f.found_count, f.first_find);
+        DROP TABLE #user_activity_finds;
+    """)
+
+    # The recent finds are counted one by one and recorded as seen from the same rows
+    return merge_new_finds(cursor_op, cursor_dwh, newest)
+
+
+def merge_new_finds(cursor_op, cursor_dwh, since):
+    """
+    Adds the finds not counted yet to user_activity. The finds logged from LATE_FIND_HOURS
+    before the watermark on are staged, the ones already in user_activity_seen are dropped and
+    the rest is aggregated per hunter and merged in one statement. Finds committed later with
+    a log_time at or just before the watermark are counted this way, each exactly once.
+    Nothing is committed.
+    Args:
+        cursor_op (pyodbc.Cursor): The cursor object for the 'catchem' database.
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        since (datetime): The watermark.
+    Returns:
+        datetime: The newest log_time seen, never older than the watermark.
+    """
+    cursor_dwh.execute("""
+        IF OBJECT_ID('tempdb..#user_activity_logs') IS NOT NULL DROP TABLE #user_activity_logs;
+        CREATE TABLE #user_activity_logs (
+            logId BINARY(16) NOT NULL PRIMARY KEY,
+            userId BINARY(16) NOT NULL,
+            log_time DATETIME NOT NULL
+        );
+    """)
+    newest = since
+    with BulkWriter(cursor_dwh, '#user_activity_logs', ['logId', 'userId', 'log_time'],
+                    commit_every=0, label='user_activity new finds') as writer:
+        for rows in iter_batches(cursor_op, recent_finds_query, (since - timedelta(hours=LATE_FIND_HOURS),)):
+            for log_id, hunter_id, log_time in rows:
+                writer.add((log_id, hunter_id, log_time))
+                if log_time > newest:
+                    newest = log_time
+
+    cursor_dwh.execute("""
+        DELETE l FROM #user_activity_logs AS l
+        WHERE EXISTS (SELECT 1 FROM user_activity_seen AS s WHERE s.logId = l.logId);
+
+        MERGE user_activity AS a
+        USING (SELECT userId, COUNT(*) AS found_count, MIN(log_time) AS first_find
+               FROM #user_activity_logs
+               GROUP BY userId) AS f ON a.userId = f.userId
+        WHEN MATCHED THEN UPDATE SET
+            found_count = a.found_count + f.found_count,
+            first_find = CASE WHEN a.first_find IS NULL OR f.first_find < a.first_find
+                              THEN f.first_find ELSE a.first_find END,
+            updated_at = SYSDATETIME()
+        WHEN NOT MATCHED THEN INSERT (userId, found_count, first_find)
+            VALUES (f.userId, f.found_count, f.first_find);
+
+        INSERT INTO user_activity_seen (logId, log_time)
+        SELECT logId, log_time FROM #user_activity_logs;
+
+        -- The next refresh only reads back to LATE_FIND_HOURS before the new watermark
+        DELETE FROM user_activity_seen WHERE log_time < DATEADD(HOUR, -?, ?);
+
+        DROP TABLE #user_activity_logs;
+    """, (LATE_FIND_HOURS, newest))
+    return newest
+
+
+def sync_owners(cursor_op, cursor_dwh):
+    """
+    Sets owns_treasure in user_activity from the current treasure owners. The owners are read
+    once with a DISTINCT, so no join fans out over the treasures; only flags that differ are written.
+    Nothing is committed.
+    Args:
+        cursor_op (pyodbc.Cursor): The cursor object for the 'catchem' database.
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+    """
+    cursor_dwh.execute("""
+        IF OBJECT_ID('tempdb..#user_activity_owners') IS NOT NULL DROP TABLE #user_activity_owners;
+        CREATE TABLE #user_activity_owners (userId BINARY(16) NOT NULL PRIMARY KEY);
+    """)
+    with BulkWriter(cursor_dwh, '#user_activity_owners', ['userId'], commit_every=0,
+                    label='user_activity owners') as writer:
+        for rows in iter_batches(cursor_op, owners_query):
+            writer.extend((owner_id,) for (owner_id,) in rows)
+
+    cursor_dwh.execute("""
+        INSERT INTO user_activity (userId)
+        SELECT o.userId FROM #user_activity_owners o
+        WHERE NOT EXISTS (SELECT 1 FROM user_activity a WHERE a.userId = o.userId);
+
+        UPDATE a
+        SET owns_treasure = CASE WHEN o.userId IS NULL THEN 0 ELSE 1 END, updated_at = SYSDATETIME()
+        FROM user_activity a
+        LEFT JOIN #user_activity_owners o ON o.userId = a.userId
+        WHERE a.owns_treasure <> CASE WHEN o.userId IS NULL THEN 0 ELSE 1 END;
+
+        DROP TABLE #user_activity_owners;
+    """)
+
+
+def refresh_user_activity(cursor_op, cursor_dwh):
+    """
+    Brings user_activity up to date: the finds not counted by the last refresh are added,
+    the owner flags are synchronized and the watermark moves, all in one transaction.
+    Args:
+        cursor_op (pyodbc.Cursor): The cursor object for the 'catchem' database.
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+    """
+    since = get_watermark(cursor_dwh, WATERMARK_SOURCE)
+    try:
+        if since is None:
+            newest = merge_all_finds(cursor_op, cursor_dwh)
+        else:
+            newest = merge_new_finds(cursor_op, cursor_dwh, since)
+        sync_owners(cursor_op, cursor_dwh)
+        if newest is not None:
+            set_watermark(cursor_dwh, WATERMARK_SOURCE, newest)
+        cursor_dwh.commit()
+    except pyodbc.Error:
+        cursor_dwh.rollback()
+        raise
+    print(f"user_activity refreshed (finds not counted before {since})")
+
+
+def main():
+    try:
+        conn_op = establish_connection(SERVER, DATABASE_OP, USERNAME, PASSWORD, DRIVER)
+        cursor_op = conn_op.cursor()
+
+        conn_dwh = establish_connection(SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER)
+        cursor_dwh = conn_dwh.cursor()
+
+        create_watermark_table(cursor_dwh)
+        create_user_activity_table(cursor_dwh)
+        refresh_user_activity(cursor_op, cursor_dwh)
+
+        cursor_op.close()
+        cursor_dwh.close()
+        conn_op.close()
+        conn_dwh.close()
+
+    except pyodbc.Error as e:
+        print(f"Error refreshing user_activity: {e}")
+
+
+if __name__ == "__main__":
+    main()
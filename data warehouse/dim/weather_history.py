@@ -1,9 +1,20 @@
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
 import requests
 import pyodbc
 from datetime import datetime, timedelta, date
 import calendar
 from config import SERVER, DATABASE_OP, USERNAME, PASSWORD, DRIVER
-from dwh import establish_connection
+from dwh import BulkWriter, establish_connection
 
 API_BASE_URL = "https://archive-api.open-meteo.com/v1/archive"
 API_PARAMS = {
@@ -13,11 +24,131 @@ API_PARAMS = {
     "timeformat": "iso8601"
 }
 
+WEATHER_HISTORY_COLUMNS = ['city_key', 'date', 'hour', 'weather_code', 'rain_id']
+
+# Store weather_history with PAGE compression
+WEATHER_PAGE_COMPRESSION = False
+
+# Hours with at least this much precipitation (mm) are 'RAIN'
+RAIN_THRESHOLD_MM = 1.0
+
+# dimRain categories (catchem_dwh.dbo.dimRain) of the hours without and with rain; their
+# rain_id is looked up by name, like the fact load looks up 'Unknown'
+RAIN_CATEGORY_NO_RAIN = 'No Rain'
+RAIN_CATEGORY_WITH_RAIN = 'With Rain'
+
+HOURLY_VARIABLES = ["temperature_2m", "precipitation", "weathercode"]
+
+# Compressed archive API responses, one file per location and month
+WEATHER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weather_cache')
+
+# Months that ended less than this many days ago may still be revised by the archive, so they aren't cached
+CACHE_SETTLE_DAYS = 7
+
+# Consecutive uncached months are fetched in one request of at most this many months
+MAX_MONTHS_PER_REQUEST = 12
+
+# Maximum number of concurrent API requests
+FETCH_WORKERS = 8
+
+# Retries per request for connection errors, timeouts, 429 and 5xx responses
+FETCH_RETRIES = 4
+
+# Seconds before the first retry; doubles with every retry
+BACKOFF_BASE = 1.0
+
+# Seconds to wait for a response
+FETCH_TIMEOUT = 30
+
+# Rounds in which requests that failed all their retries are attempted again
+FETCH_ROUNDS = 3
+
+# One requests.Session per fetcher thread
+_thread_state = threading.local()
+
 
-def create_weather_history_table(cursor):
-    """Create the 'weather_history' table in the operational database."""
+def create_weather_city_table(cursor):
+    """
+    Create the 'weather_city' table that gives every city with weather a small integer key.
+    A city is identified by its operational city_id, as city names are not unique. A table
+    of the first layout (keyed by a unique city_name) gets the city_id column instead.
+    """
+    cursor.execute("""
+    IF NOT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'weather_city')
+    BEGIN
+    CREATE TABLE weather_city (
+        city_key SMALLINT IDENTITY(1,1) PRIMARY KEY,
+        city_id BINARY(16) NULL,
+        city_name VARCHAR(255) NOT NULL,
+        latitude FLOAT NULL,
+        longitude FLOAT NULL
+    )
+    END
+
+    IF COL_LENGTH('weather_city', 'city_id') IS NULL
+    BEGIN
+        ALTER TABLE weather_city ADD city_id BINARY(16) NULL;
+
+        DECLARE @unique_name SYSNAME = (SELECT name FROM sys.key_constraints
+                                        WHERE parent_object_id = OBJECT_ID('weather_city') AND type = 'UQ');
+        IF @unique_name IS NOT NULL
+            EXEC('ALTER TABLE weather_city DROP CONSTRAINT ' + @unique_name);
+    END
+    """)
+    # A separate batch, so the index is compiled after the column exists
+    cursor.execute("""
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'UX_weather_city_city_id' AND object_id = OBJECT_ID('weather_city'))
+        CREATE UNIQUE INDEX UX_weather_city_city_id ON weather_city (city_id) WHERE city_id IS NOT NULL;
+    """)
+
+
+def assign_city_ids(cursor):
+    """
+    Gives the weather_city rows created by name (the first layout, or migrated from
+    weather_history_v1) the city_id of the only city with that name. Names shared by several
+    cities can't tell whose weather was stored, so those rows and their weather are removed
+    and fetched again per city.
+    Args:
+        cursor (pyodbc.Cursor): The cursor object for the operational database.
+    """
+    cursor.execute("""
+    UPDATE wc
+    SET city_id = CAST(c.city_id AS BINARY(16))
+    FROM weather_city wc
+    JOIN city c ON c.city_name = wc.city_name
+    WHERE wc.city_id IS NULL
+      AND (SELECT COUNT(*) FROM city c2 WHERE c2.city_name = wc.city_name) = 1;
+
+    DELETE w FROM weather_history w
+    JOIN weather_city wc ON wc.city_key = w.city_key
+    WHERE wc.city_id IS NULL;
+
+    DELETE FROM weather_city WHERE city_id IS NULL;
+    """)
+
+
+def create_weather_history_table(cursor, page_compression=WEATHER_PAGE_COMPRESSION):
+    """
+    Create the 'weather_history' table in the operational database. It is clustered on
+    (city_key, date, hour), the key the fact load looks weather up by, so lookups and date range
+    scans of a city read adjacent rows. The clustered key ignores duplicate keys, so an
+    overlapping load skips the hours it already has. rain_id holds the dimRain key of the hour,
+    looked up by category name (see fetch_rain_ids); dimRain lives in the data warehouse, so
+    there is no foreign key.
+    A weather_history table of the old layout (city name per row) is migrated first.
+    Args:
+        cursor (pyodbc.Cursor): The cursor object for the operational database.
+        page_compression (bool): Create the table with PAGE data compression.
+    """
+    options = "IGNORE_DUP_KEY = ON" + (", DATA_COMPRESSION = PAGE" if page_compression else "")
     try:
-        create_history_query = """
+        create_weather_city_table(cursor)
+        # The old layout stored the city name on every row
+        cursor.execute("SELECT COL_LENGTH('weather_history', 'city')")
+        if cursor.fetchone()[0] is not None:
+            cursor.execute("EXEC sp_rename 'weather_history', 'weather_history_v1'")
+
+        create_history_query = f"""
         IF NOT EXISTS (
             SELECT 1
             FROM INFORMATION_SCHEMA.TABLES
@@ -25,112 +156,398 @@ def create_weather_history_table(cursor):
         )
         BEGIN
         CREATE TABLE weather_history (
-            id INT IDENTITY(1,1) PRIMARY KEY,
-            date DATETIME,
-            day INT,
-            hour INT,
-            city VARCHAR(255),
-            weather_code INT,
-            weather_type VARCHAR(50)
+            city_key SMALLINT NOT NULL REFERENCES weather_city (city_key),
+            date DATE NOT NULL,
+            hour TINYINT NOT NULL,
+            weather_code SMALLINT NULL,
+            rain_id TINYINT NOT NULL,
+            CONSTRAINT PK_weather_history PRIMARY KEY CLUSTERED (city_key, date, hour) WITH ({options})
         )
         END
         """
         cursor.execute(create_history_query)
+        migrate_weather_history_v1(cursor)
+        assign_city_ids(cursor)
+        cursor.commit()
         print("weather_history table created successfully.")
     except pyodbc.Error as e:
         print(f"Error creating weather_history table: {e}")
 
 
-def categorize_weather_type(precipitation):
-    """Categorize weather type based on precipitation."""
-    if precipitation is None or precipitation < 1.0:
-        return 'NO RAIN'
-    else:
-        return 'RAIN'
+def migrate_weather_history_v1(cursor):
+    """
+    Copies the rows of the old weather_history layout (renamed to 'weather_history_v1') into
+    the compact table, once. The 'UNKNOWN' placeholder rows of failed downloads are left out,
+    so the unique key doesn't make the real weather of those hours be skipped when it is fetched.
+    weather_history_v1 is kept and can be dropped after checking.
+    Args:
+        cursor (pyodbc.Cursor): The cursor object for the operational database.
+    """
+    cursor.execute(f"""
+    IF OBJECT_ID('weather_history_v1') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM weather_history)
+    BEGIN
+        INSERT INTO weather_city (city_name)
+        SELECT DISTINCT w.city FROM weather_history_v1 w
+        WHERE w.city IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM weather_city c WHERE c.city_name = w.city);
+
+        INSERT INTO weather_history (city_key, date, hour, weather_code, rain_id)
+        SELECT c.city_key, CAST(w.date AS DATE), w.hour, w.weather_code, r.rain_id
+        FROM weather_history_v1 w
+        JOIN weather_city c ON c.city_name = w.city
+        JOIN catchem_dwh.dbo.dimRain r
+          ON r.rain_category = CASE w.weather_type WHEN 'NO RAIN' THEN '{RAIN_CATEGORY_NO_RAIN}'
+                                                   WHEN 'RAIN' THEN '{RAIN_CATEGORY_WITH_RAIN}' END
+        WHERE w.weather_type IN ('NO RAIN', 'RAIN');
+    END
+    """)
+
+
+def fetch_rain_ids(cursor):
+    """
+    Looks up the dimRain keys of the hours without and with rain by category name.
+    Args:
+        cursor (pyodbc.Cursor): The cursor object for the operational database.
+    Returns:
+        tuple: (rain_id of RAIN_CATEGORY_NO_RAIN, rain_id of RAIN_CATEGORY_WITH_RAIN).
+    """
+    cursor.execute("SELECT rain_category, rain_id FROM catchem_dwh.dbo.dimRain WHERE rain_category IN (?, ?)",
+                   (RAIN_CATEGORY_NO_RAIN, RAIN_CATEGORY_WITH_RAIN))
+    rain_ids = {rain_category: rain_id for rain_category, rain_id in cursor.fetchall()}
+    return rain_ids[RAIN_CATEGORY_NO_RAIN], rain_ids[RAIN_CATEGORY_WITH_RAIN]
+
+
+def fetch_city_keys(cursor, cities):
+    """
+    Returns the weather_city key of every city, adding the cities that don't have one yet.
+    Args:
+        cursor (pyodbc.Cursor): The cursor object for the operational database.
+        cities (list): (city_id, city_name, latitude, longitude) tuples; city_id as BINARY(16).
+    Returns:
+        list: The city_key of every city, in the order of cities.
+    """
+    city_keys = []
+    for city_id, city_name, latitude, longitude in cities:
+        cursor.execute("""
+        IF NOT EXISTS (SELECT 1 FROM weather_city WHERE city_id = ?)
+            INSERT INTO weather_city (city_id, city_name, latitude, longitude) VALUES (?, ?, ?, ?)
+        """, (city_id, city_id, city_name, latitude, longitude))
+        cursor.execute("SELECT city_key FROM weather_city WHERE city_id = ?", (city_id,))
+        city_keys.append(cursor.fetchone()[0])
+    cursor.commit()
+    return city_keys
 
 
-def retrieve_and_insert_hourly_weather_data(city_name, latitude, longitude, start_year, end_date, cursor):
-    """Retrieve and insert hourly weather data for a city into 'weather_history'."""
-    end_year = end_date.year
+def month_ranges(start_date, end_date):
+    """
+    Splits the period from start_date up to yesterday into calendar months; the first range
+    starts at start_date and the last one ends yesterday, as the current day isn't complete yet.
+    Args:
+        start_date (date): The first day to fetch.
+        end_date (date): The day after the last day to fetch (usually today).
+    Returns:
+        list: (first day, last day) datetime tuples, one per month.
+    """
     yesterday = end_date - timedelta(days=1)
+    ranges = []
+    first_day = datetime(start_date.year, start_date.month, start_date.day)
+    while first_day.date() <= yesterday:
+        last_day = datetime(first_day.year, first_day.month, calendar.monthrange(first_day.year, first_day.month)[1])
+        if last_day.date() > yesterday:
+            last_day = datetime(yesterday.year, yesterday.month, yesterday.day)
+        ranges.append((first_day, last_day))
+        first_day = last_day + timedelta(days=1)
+    return ranges
+
+
+def fetch_loaded_hours(cursor):
+    """
+    Counts the hours loaded into 'weather_history' per city and month, so months that are
+    missing or incomplete (e.g. a month that failed to download while later ones loaded)
+    can be fetched again.
+    Args:
+        cursor (pyodbc.Cursor): The cursor object for the operational database.
+    Returns:
+        dict: city_key -> {(year, month): number of hours loaded}.
+    """
+    cursor.execute("""
+        SELECT city_key, YEAR(date), MONTH(date), COUNT(*)
+        FROM weather_history
+        GROUP BY city_key, YEAR(date), MONTH(date)
+    """)
+    loaded = {}
+    for city_key, year, month, hours in cursor.fetchall():
+        loaded.setdefault(city_key, {})[(year, month)] = hours
+    return loaded
+
+
+def months_to_load(start_date, end_date, loaded_hours):
+    """
+    Returns the months of a city that don't have all their hours in 'weather_history' yet.
+    Args:
+        start_date (date): The first day to fetch.
+        end_date (date): The day after the last day to fetch (usually today).
+        loaded_hours (dict): (year, month) -> number of hours loaded, see fetch_loaded_hours.
+    Returns:
+        list: (first day, last day) datetime tuples, one per incomplete month.
+    """
+    return [(first_day, last_day) for first_day, last_day in month_ranges(start_date, end_date)
+            if loaded_hours.get((first_day.year, first_day.month), 0) < ((last_day - first_day).days + 1) * 24]
+
+
+def cache_path(latitude, longitude, start_date, end_date):
+    """
+    Returns the cache file of one location, period and set of variables.
+    Args:
+        latitude (float): The latitude of the location.
+        longitude (float): The longitude of the location.
+        start_date (datetime): The first day.
+        end_date (datetime): The last day.
+    Returns:
+        str: The path of the gzipped JSON file.
+    """
+    key = f"{float(latitude):.4f}|{float(longitude):.4f}|{start_date:%Y-%m-%d}|{end_date:%Y-%m-%d}|{','.join(HOURLY_VARIABLES)}"
+    return os.path.join(WEATHER_CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json.gz')
+
+
+def read_cache(latitude, longitude, start_date, end_date):
+    """
+    Reads a cached response.
+    Returns:
+        dict: The cached 'hourly' part of the response, or None when it isn't cached.
+    """
+    path = cache_path(latitude, longitude, start_date, end_date)
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rt', encoding='utf-8') as cache_file:
+        return json.load(cache_file)
+
+
+def write_cache(latitude, longitude, start_date, end_date, hourly):
+    """
+    Caches the 'hourly' part of a response, unless the period is too recent to be final.
+    The file is written under a temporary name first, so a crash never leaves half a file.
+    """
+    if end_date.date() > date.today() - timedelta(days=CACHE_SETTLE_DAYS):
+        return
+    path = cache_path(latitude, longitude, start_date, end_date)
+    os.makedirs(WEATHER_CACHE_DIR, exist_ok=True)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as cache_file:
+        json.dump(hourly, cache_file)
+    os.replace(path + '.tmp', path)
+
+
+def coalesce_months(months):
+    """
+    Merges consecutive months into ranges of at most MAX_MONTHS_PER_REQUEST months,
+    so they are fetched with one request.
+    Args:
+        months (list): (first day, last day) tuples in chronological order.
+    Returns:
+        list: (first day, last day) tuples of the merged ranges.
+    """
+    ranges = []
+    for first_day, last_day in months:
+        if ranges and ranges[-1][2] < MAX_MONTHS_PER_REQUEST \
+                and ranges[-1][1] + timedelta(days=1) == first_day:
+            ranges[-1] = (ranges[-1][0], last_day, ranges[-1][2] + 1)
+        else:
+            ranges.append((first_day, last_day, 1))
+    return [(first_day, last_day) for first_day, last_day, _ in ranges]
+
+
+def split_by_month(hourly, months):
+    """
+    Splits the 'hourly' part of a response over the months it covers.
+    Args:
+        hourly (dict): The time and variable arrays of the response.
+        months (list): (first day, last day) tuples of the months in the response.
+    Returns:
+        list: ((first day, last day), hourly dict of that month) tuples.
+    """
+    parts = []
+    for first_day, last_day in months:
+        prefix = f"{first_day:%Y-%m}"
+        indexes = [i for i, time_text in enumerate(hourly['time']) if time_text.startswith(prefix)]
+        parts.append(((first_day, last_day),
+                      {variable: [values[i] for i in indexes] for variable, values in hourly.items()}))
+    return parts
 
-    # iterate through years and months
-    # This loop iterates over each year starting from start_year up to and including end_year.
-    # For example, if start_year is 2020 and end_year is 2022, it will iterate for 2020, 2021, and 2022.
-    for year in range(start_year, end_year + 1):
-        # This line calculates the end month for the current year of iteration.
-        # If the current year is less than yesterday.year, end_month_iter is set to 13.
-        # This is because we want to iterate through all 12 months of the year.
-        # If the current year is equal or greater than yesterday.year, end_month_iter is set to yesterday.month + 1.
-        # This is to ensure we don't fetch data for future months beyond yesterday's date.
-        # yesterday.month + 1 ensures we include the current month as well.
-        end_month_iter = 13 if year < yesterday.year else yesterday.month + 1
-        # This loop iterates over each month from 1 up to end_month_iter.
-        # If end_month_iter is set to 13, it will iterate through 1 to 12.
-        # If end_month_iter is set to a specific month, it will iterate up to that month.
-        for month in range(1, end_month_iter):
-            # This creates a datetime object for the first day of the current month and year.
-            start_date = datetime(year, month, 1)
-            # This creates a datetime object for the last day of the current month and year.
-            end_date = datetime(year, month, calendar.monthrange(year, month)[1])
-            # if year == yesterday.year and month == yesterday.month: This condition checks if the current year and
-            # month match yesterday's year and month. end_date = yesterday If the condition is met, end_date is set
-            # to yesterday. This adjustment ensures that we don't fetch data for the current day since it might not
-            # have complete data for the full day yet.
-            if year == yesterday.year and month == yesterday.month:
-                end_date = yesterday
-
-            # This constructs the parameters for the API request.
-            # It includes latitude, longitude, start_date, end_date, and the hourly weather information to fetch.
-            params = {
-                "latitude": latitude,
-                "longitude": longitude,
-                "start_date": start_date.strftime('%Y-%m-%d'),
-                "end_date": end_date.strftime('%Y-%m-%d'),
-                "hourly": ["temperature_2m", "precipitation", "weathercode"]
-            }
-
-            # Http request to the API
-            response = requests.get(API_BASE_URL, params=params)
-
-            # If the API request is successful (status code 200), it processes the data:
-            # Extracts hourly weather information from the API response.
-            # Categorizes weather type using categorize_weather_type.
-            # Converts the time string to a datetime object.
-            # Constructs an SQL INSERT query to insert weather data into the weather_history table.
-            # Executes the INSERT query using the database cursor.
-            # If the API request fails, it prints an error message and inserts placeholder data ('UNKNOWN') for each hour of the failed request.
 
+def get_session():
+    """
+    Returns the HTTP session of the current thread, so every fetcher thread reuses its connections.
+    """
+    session = getattr(_thread_state, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _thread_state.session = session
+    return session
+
+
+def fetch_hourly_weather(latitude, longitude, start_date, end_date):
+    """
+    Fetches the hourly weather of one location and period, retrying transient failures
+    (connection errors, timeouts, 429 and 5xx responses) with exponential backoff and jitter.
+    Args:
+        latitude (float): The latitude of the location.
+        longitude (float): The longitude of the location.
+        start_date (datetime): The first day.
+        end_date (datetime): The last day.
+    Returns:
+        dict: The API response.
+    Raises:
+        requests.RequestException: When the request still fails after FETCH_RETRIES retries,
+            or fails with a status that retrying won't fix.
+    """
+    params = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "start_date": start_date.strftime('%Y-%m-%d'),
+        "end_date": end_date.strftime('%Y-%m-%d'),
+        "hourly": HOURLY_VARIABLES
+    }
+    for attempt in range(FETCH_RETRIES + 1):
+        try:
+            response = get_session().get(API_BASE_URL, params=params, timeout=FETCH_TIMEOUT)
             if response.status_code == 200:
-                # If the response is successful, it converts the JSON response to a Python dictionary stored in data.
-                data = response.json()
-                # Here, it's using the zip function to iterate over four lists simultaneously:
-                # data['hourly']['time']: List of times (in string format).
-                # data['hourly']['temperature_2m']: List of temperatures.
-                # data['hourly']['precipitation']: List of precipitation values.
-                # data['hourly']['weathercode']: List of weather codes.
-                for time, temperature, precipitation, weather_code in zip(data['hourly']['time'],
-                                                                          data['hourly']['temperature_2m'],
-                                                                          data['hourly']['precipitation'],
-                                                                          data['hourly']['weathercode']):
-                    weather_type = categorize_weather_type(precipitation)
-                    datetime_obj = datetime.strptime(time, '%Y-%m-%dT%H:%M')
-                    insert_query = """INSERT INTO weather_history (date,day,hour, city,weather_code, weather_type) 
-                                      VALUES (?, ?, ?,?,?,?)"""
-                    cursor.execute(insert_query, (
-                        datetime_obj, datetime_obj.day, datetime_obj.hour,
-                        city_name, weather_code, weather_type))
-            else:
-                print(f"Failed to fetch data for {city_name} in {year}-{month}: {response.status_code}")
-                for hour in range(24):
-                    date_time = datetime(year, month, 1, hour, 0)
-                    insert_query = """INSERT INTO weather_history (date,day,hour, city,weather_code, weather_type) 
-                                                     VALUES (?, ?, ?,?,?,?)"""
-                    cursor.execute(insert_query, (
-                        date_time, date_time.day, date_time.hour,
-                        city_name, None, 'UNKNOWN'))
+                return response.json()
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+            error = requests.HTTPError(f"HTTP {response.status_code}", response=response)
+            retry_after = response.headers.get('Retry-After')
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error, retry_after = e, None
 
-    cursor.commit()
+        if attempt == FETCH_RETRIES:
+            raise error
+        delay = BACKOFF_BASE * 2 ** attempt + random.uniform(0, BACKOFF_BASE)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        time.sleep(delay)
+
+
+def is_permanent_failure(error):
+    """
+    Tells whether a failed request would fail the same way again: a 4xx response other than 429.
+    Args:
+        error (requests.RequestException): The error raised by fetch_hourly_weather.
+    Returns:
+        bool: True when retrying is pointless.
+    """
+    response = getattr(error, 'response', None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
+
+
+def fetch_weather_concurrently(tasks, workers=FETCH_WORKERS, rounds=FETCH_ROUNDS):
+    """
+    Fetches the hourly weather of many (city, month) tasks on a bounded thread pool.
+    Tasks that still fail after their retries are queued again for a next round instead of
+    being replaced by placeholder rows; what fails in every round is reported and skipped.
+    Tasks rejected with a permanent error (see is_permanent_failure) are reported and skipped at once.
+    Args:
+        tasks (list): (city_key, latitude, longitude, start_date, end_date) tuples.
+        workers (int): The maximum number of concurrent requests.
+        rounds (int): How many times failed tasks are attempted again.
+    Yields:
+        tuple: (task, response data) for every successful task, in completion order.
+    """
+    pending = list(tasks)
+    for round_no in range(1, rounds + 1):
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch_hourly_weather, *task[1:]): task for task in pending}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    yield task, future.result()
+                except requests.RequestException as e:
+                    if is_permanent_failure(e):
+                        print(f"Skipping weather_city {task[0]} from {task[3]:%Y-%m-%d} to {task[4]:%Y-%m-%d}, "
+                              f"the request was rejected: {e}")
+                        continue
+                    print(f"Failed to fetch data for weather_city {task[0]} from {task[3]:%Y-%m-%d} (round {round_no}): {e}")
+                    failed.append(task)
+        if not failed:
+            return
+        pending = failed
+    for task in pending:
+        print(f"Giving up on weather_city {task[0]} from {task[3]:%Y-%m-%d} to {task[4]:%Y-%m-%d}; it is fetched again next run")
+
+
+def hourly_frame(city_key, hourly, rain_ids):
+    """
+    Converts the 'hourly' part of a response into weather_history rows, column by column:
+    the timestamps are parsed and the precipitation is thresholded for all hours at once.
+    The archive returns nulls for its most recent days; those hours are left out, so they
+    still count as missing (see months_to_load) and are fetched again by a later run.
+    Args:
+        city_key (int): The weather_city key of the city the weather belongs to.
+        hourly (dict): The time and variable arrays.
+        rain_ids (tuple): The dimRain keys of no rain and rain, see fetch_rain_ids.
+    Returns:
+        pd.DataFrame: The WEATHER_HISTORY_COLUMNS of every hour with a precipitation value.
+    """
+    no_rain_id, with_rain_id = rain_ids
+    moments = pd.to_datetime(pd.Series(hourly['time']), format='%Y-%m-%dT%H:%M')
+    precipitation = pd.to_numeric(pd.Series(hourly['precipitation'], dtype=object), errors='coerce')
+    hours = pd.DataFrame({
+        'city_key': city_key,
+        'date': moments.dt.date,
+        'hour': moments.dt.hour,
+        'weather_code': pd.array(pd.to_numeric(pd.Series(hourly['weathercode'], dtype=object), errors='coerce'),
+                                 dtype='Int64'),
+        # Hours with at least RAIN_THRESHOLD_MM of precipitation are rain
+        'rain_id': np.where(precipitation >= RAIN_THRESHOLD_MM, with_rain_id, no_rain_id),
+    }, columns=WEATHER_HISTORY_COLUMNS)
+    return hours[precipitation.notna().to_numpy()]
+
+
+def retrieve_and_insert_weather_data(cities, start_year, end_date, cursor, loaded_hours=None):
+    """
+    Retrieve and insert hourly weather data for several cities into 'weather_history'.
+    Months found in the on-disk cache are not downloaded again; the other months are merged
+    into as few requests as possible and fetched concurrently. Rows are written by this thread only.
+    Args:
+        cities (list): (city_id, city_name, latitude, longitude) tuples; city_id as BINARY(16).
+        start_year (int): The first year to fetch.
+        end_date (date): The day after the last day to fetch (usually today).
+        cursor (pyodbc.Cursor): The cursor object for the operational database.
+        loaded_hours (dict, optional): city_key -> {(year, month): hours loaded} (see fetch_loaded_hours);
+            only the months of a city that are missing hours are fetched, the hours already
+            loaded are skipped by the unique key.
+    """
+    loaded_hours = loaded_hours or {}
+    city_keys = fetch_city_keys(cursor, cities)
+    rain_ids = fetch_rain_ids(cursor)
+
+    # Rows are buffered and bulk inserted, committed once at the end
+    with BulkWriter(cursor, 'weather_history', WEATHER_HISTORY_COLUMNS, label='weather_history') as writer:
+        tasks = []
+        cached = 0
+        months = {}
+        for city_key, (city_id, city_name, latitude, longitude) in zip(city_keys, cities):
+            months[city_key] = months_to_load(date(start_year, 1, 1), end_date, loaded_hours.get(city_key, {}))
+
+            missing = []
+            for first_day, last_day in months[city_key]:
+                hourly = read_cache(latitude, longitude, first_day, last_day)
+                if hourly is None:
+                    missing.append((first_day, last_day))
+                else:
+                    writer.write_frame(hourly_frame(city_key, hourly, rain_ids))
+                    cached += 1
+            tasks.extend((city_key, latitude, longitude, first_day, last_day)
+                         for first_day, last_day in coalesce_months(missing))
+        print(f"{cached} months read from the cache, {len(tasks)} requests to send")
+
+        for (city_key, latitude, longitude, first_day, last_day), data in fetch_weather_concurrently(tasks):
+            covered = [month for month in months[city_key] if first_day <= month[0] <= last_day]
+            for (month_first, month_last), hourly in split_by_month(data['hourly'], covered):
+                # A month the archive hasn't filled in completely yet is fetched again, not cached
+                if all(value is not None for value in hourly['precipitation']):
+                    write_cache(latitude, longitude, month_first, month_last, hourly)
+            writer.write_frame(hourly_frame(city_key, data['hourly'], rain_ids))
 
 
 def main():
@@ -145,21 +562,20 @@ def main():
 
             # Retrieve top 10 cities with the most treasures found
             popular_cities_query = """
-                SELECT TOP (10) c.city_name, c.latitude, c.longitude
+                SELECT TOP (10) CAST(c.city_id AS BINARY(16)), c.city_name, c.latitude, c.longitude
                 FROM city c
                 JOIN treasure t ON t.city_city_id = c.city_id
                 JOIN treasure_log tl ON t.id = tl.treasure_id
-                GROUP BY c.city_name, c.latitude, c.longitude
+                GROUP BY c.city_id, c.city_name, c.latitude, c.longitude
                 ORDER BY COUNT(tl.log_time) DESC
                 """
             cursor_op.execute(popular_cities_query)
             pop_cities = cursor_op.fetchall()
 
-           # For each city, it calls retrieve_and_insert_hourly_weather_data to fetch and insert weather data into
-            # the weather_history table.
-            for city_info in pop_cities:
-                city_name, latitude, longitude = city_info
-                retrieve_and_insert_hourly_weather_data(city_name, latitude, longitude, 2020, date.today(), cursor_op)
+            # Fetch only the months since 2020 each city is still missing hours of
+            # and insert them into the weather_history table
+            loaded_hours = fetch_loaded_hours(cursor_op)
+            retrieve_and_insert_weather_data(pop_cities, 2020, date.today(), cursor_op, loaded_hours)
 
             print("Data insertion completed.")
         except pyodbc.Error as e:
@@ -1,172 +1,597 @@
 import logging
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
 
 import pandas as pd
 import pyodbc
 
+import aggregates
 import dwh as dwh
-from config import SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER
+from config import (SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER, FACT_LOAD_WORKERS,
+                    FACT_COLUMNSTORE, FACT_PARTITION_BY_DAY)
 
 logging.basicConfig(level=logging.INFO)
 
+# Years covered by the monthly partitions of factTreasureFound; later days land in the last partition
+PARTITION_YEARS = range(2020, 2041)
 
-def create_table(cursor_dwh):
+# Name of the factTreasureFound load in the etl_watermark table
+WATERMARK_SOURCE = 'factTreasureFound'
+
+# Logs whose hunter has no dimUser version or whose treasure has no type yet are retried by the next
+# loads (the watermark is held at the oldest of them) for this many days, then given up on
+UNRESOLVED_RETRY_DAYS = 7
+
+TREASURE_LOG_COLUMNS = ['id', 'log_time', 'hunter_id', 'treasure_id', 'session_start', 'city_id']
+
+FACT_COLUMNS = ['TreasureLogID', 'DIM_USER_SK', 'DIM_TREASURE_TYPE_SK', 'DIM_DAY_SK', 'DIM_HOUR_SK', 'RAIN_ID', 'Duration']
+
+
+def create_partitioning(cursor_dwh):
     """
-    Create the 'factTreasureFound' table in the data warehouse.
+    Create the monthly partition function and scheme on the yyyymmdd day key, if they don't exist.
     :param cursor_dwh: Data warehouse cursor object
     :return: None
     """
+    boundaries = ", ".join(str(year * 10000 + month * 100 + 1)
+                           for year in PARTITION_YEARS for month in range(1, 13))
+    cursor_dwh.execute(f"""
+        IF NOT EXISTS (SELECT * FROM sys.partition_functions WHERE name = 'pf_factTreasureFound_day')
+            CREATE PARTITION FUNCTION pf_factTreasureFound_day (INT) AS RANGE RIGHT FOR VALUES ({boundaries});
+    """)
+    cursor_dwh.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.partition_schemes WHERE name = 'ps_factTreasureFound_day')
+            CREATE PARTITION SCHEME ps_factTreasureFound_day AS PARTITION pf_factTreasureFound_day ALL TO ([PRIMARY]);
+    """)
+
+
+def create_table(cursor_dwh, columnstore=FACT_COLUMNSTORE, partition_by_day=FACT_PARTITION_BY_DAY):
+    """
+    Create the 'factTreasureFound' table in the data warehouse if it doesn't exist.
+    TreasureLogID is the treasure_log id (degenerate key); its unique index keeps reloads idempotent.
+    With columnstore the table is stored as a clustered columnstore index, so the star-join
+    aggregates in queries.sql run in batch mode; with partition_by_day it is partitioned by
+    month on DIM_DAY_SK. Changing either option on an existing table needs a full reload.
+    :param cursor_dwh: Data warehouse cursor object
+    :param columnstore: store the table as a clustered columnstore index
+    :param partition_by_day: partition the table by month of DIM_DAY_SK
+    :return: None
+    """
+    # The clustered index is the columnstore or, when partitioned, the day key, so the primary
+    # key becomes nonclustered; aligned unique indexes must contain the partitioning column.
+    if columnstore or partition_by_day:
+        primary_key = "CONSTRAINT PK_factTreasureFound PRIMARY KEY NONCLUSTERED (TreasureFoundID{})".format(
+            ", DIM_DAY_SK" if partition_by_day else "")
+    else:
+        primary_key = "CONSTRAINT PK_factTreasureFound PRIMARY KEY (TreasureFoundID)"
+    storage = " ON ps_factTreasureFound_day (DIM_DAY_SK)" if partition_by_day else ""
+
+    if columnstore:
+        clustered_index = f"CREATE CLUSTERED COLUMNSTORE INDEX CCI_factTreasureFound ON catchem_dwh.dbo.factTreasureFound{storage};"
+    elif partition_by_day:
+        clustered_index = f"CREATE CLUSTERED INDEX CIX_factTreasureFound_day ON catchem_dwh.dbo.factTreasureFound (DIM_DAY_SK){storage};"
+    else:
+        clustered_index = ""
+
     try:
-        # Drop the table if it exists
-        cursor_dwh.execute("""
-        IF EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'factTreasureFound')
-        BEGIN
-            DROP TABLE catchem_dwh.dbo.factTreasureFound;
-        END
-        """)
+        if partition_by_day:
+            create_partitioning(cursor_dwh)
 
-        # Create the table
-        cursor_dwh.execute("""
+        # The TreasureLogID index is not partition aligned (ON [PRIMARY]) so it stays unique on its own
+        cursor_dwh.execute(f"""
+        IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'factTreasureFound')
+        BEGIN
           CREATE TABLE catchem_dwh.dbo.factTreasureFound
 (
-    TreasureFoundID INT IDENTITY (1,1) PRIMARY KEY,
-    DIM_DAY_SK INT,
+    TreasureFoundID INT IDENTITY (1,1) NOT NULL,
+    TreasureLogID   BINARY(16) NOT NULL,
+    DIM_DAY_SK INT NOT NULL,
+    DIM_HOUR_SK INT,
     DIM_TREASURE_TYPE_SK INT,
     DIM_USER_SK INT,
     RAIN_ID INT,
     Duration        INT,
     CreationDate    DATETIME2 DEFAULT GETDATE(),
     Constant        BIT,
+    {primary_key},
     FOREIGN KEY (DIM_USER_SK) REFERENCES dbo.dimUser (user_SK),
     FOREIGN KEY (DIM_TREASURE_TYPE_SK) REFERENCES dbo.dimTreasureType (treasureType_SK),
     FOREIGN KEY (DIM_DAY_SK) REFERENCES dbo.dimDay (day_SK),
+    FOREIGN KEY (DIM_HOUR_SK) REFERENCES dbo.dimHour (hour_SK),
     FOREIGN KEY (RAIN_ID) REFERENCES dbo.dimRain (RAIN_ID)
-)
+){storage};
+
+          {clustered_index}
 
+          CREATE UNIQUE NONCLUSTERED INDEX UX_factTreasureFound_TreasureLogID
+              ON catchem_dwh.dbo.factTreasureFound (TreasureLogID){" ON [PRIMARY]" if partition_by_day else ""};
+        END
         """)
-        logging.info("factTreasureFound table created successfully.")
+        cursor_dwh.commit()
+        logging.info("factTreasureFound table created successfully or already exists.")
     except pyodbc.Error as e:
         logging.error(f"Error creating factTreasureFound table: {e}")
 
-def fetch_treasure_log_data(cursor_op):
+
+def has_old_layout(cursor_dwh):
     """
-    Fetch data from the 'treasure_log' table.
-    :param cursor_op: operational database cursor object
-    :return: DataFrame containing data from the 'treasure_log' table
+    Tell whether factTreasureFound was created by the full-reload load, before it had the
+    TreasureLogID degenerate key the incremental load inserts by.
+    :param cursor_dwh: Data warehouse cursor object
+    :return: True when the table exists without a TreasureLogID column
+    """
+    cursor_dwh.execute("""
+        SELECT CASE WHEN OBJECT_ID('catchem_dwh.dbo.factTreasureFound') IS NOT NULL
+                     AND COL_LENGTH('catchem_dwh.dbo.factTreasureFound', 'TreasureLogID') IS NULL
+                    THEN 1 ELSE 0 END
+    """)
+    return cursor_dwh.fetchone()[0] == 1
+
+
+def drop_table(cursor_dwh):
+    """
+    Drop the 'factTreasureFound' table and forget its watermark, for a full reload.
+    The aggregates are emptied as well, they are rebuilt from the reloaded rows.
+    :param cursor_dwh: Data warehouse cursor object
+    :return: None
     """
     try:
-        # Fetch data from the 'treasure_log' table
-        cursor_op.execute("""
-            SELECT id, log_time, hunter_id, treasure_id, session_start
-            FROM catchem_9_2023.dbo.treasure_log
-        """)
+        cursor_dwh.execute("""
+        IF EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'factTreasureFound')
+        BEGIN
+            DROP TABLE catchem_dwh.dbo.factTreasureFound;
+        END
+        DELETE FROM etl_watermark WHERE source_name = ?
+        """, (WATERMARK_SOURCE,))
+        cursor_dwh.commit()
+        aggregates.reset_aggregates(cursor_dwh)
+        logging.info("factTreasureFound table dropped for a full reload.")
+    except pyodbc.Error as e:
+        logging.error(f"Error dropping factTreasureFound table: {e}")
 
-        # Convert the data to a DataFrame
-        treasure_log_rows = [tuple(row) for row in cursor_op.fetchall()]
-        columns = ['id', 'log_time', 'hunter_id', 'treasure_id', 'session_start']
-        df_treasure_log = pd.DataFrame(treasure_log_rows, columns=columns)
+def treasure_log_query(since=None, until=None):
+    """
+    Build the treasure_log extraction query for a log_time range.
+    :param since: only fetch logs from this log_time on (inclusive), no lower bound when None
+    :param until: only fetch logs before this log_time (exclusive), no upper bound when None
+    :return: tuple of the SQL query and its parameters
+    """
+    # The city of the treasure is needed to look up the weather at the time of the find;
+    # weather_city stores city_id as BINARY(16)
+    query = """
+        SELECT tl.id, tl.log_time, tl.hunter_id, tl.treasure_id, tl.session_start,
+               CAST(t.city_city_id AS BINARY(16)) AS city_id
+        FROM catchem_9_2023.dbo.treasure_log AS tl
+        LEFT JOIN catchem_9_2023.dbo.treasure AS t ON tl.treasure_id = t.id
+        WHERE 1 = 1
+    """
+    params = []
+    if since is not None:
+        # >= so logs sharing the watermark's timestamp are not missed; already loaded ones are skipped on insert
+        query += " AND tl.log_time >= ?"
+        params.append(since)
+    if until is not None:
+        query += " AND tl.log_time < ?"
+        params.append(until)
+    return query, tuple(params)
+
+
+def iter_treasure_log_data(cursor_op, since=None, until=None, arraysize=dwh.FETCH_SIZE):
+    """
+    Stream the 'treasure_log' table in chunks, so memory stays flat however large it grows.
+    :param cursor_op: operational database cursor object
+    :param since: only fetch logs from this log_time on (the load watermark), all logs when None
+    :param until: only fetch logs before this log_time, no upper bound when None
+    :param arraysize: number of rows per chunk
+    :return: generator of DataFrames with the TREASURE_LOG_COLUMNS
+    """
+    query, params = treasure_log_query(since, until)
+    return dwh.iter_frames(cursor_op, query, params, arraysize, TREASURE_LOG_COLUMNS)
 
-        return df_treasure_log
 
-    except pyodbc.Error as e:
-        logging.error(f"Error fetching data from treasure_log table: {e}")
-        return pd.DataFrame()
+def fetch_partition_bounds(cursor_op, partitions, since=None):
+    """
+    Split the treasure_log rows since the watermark into log_time ranges of about equal size.
+    :param cursor_op: operational database cursor object
+    :param partitions: number of ranges to split into
+    :param since: only consider logs from this log_time on, all logs when None
+    :return: list of (since, until) tuples; the last range has no upper bound
+    """
+    where, params = ("WHERE log_time >= ?", (partitions, since)) if since is not None else ("", (partitions,))
+    cursor_op.execute(f"""
+        SELECT MIN(log_time)
+        FROM (SELECT log_time, NTILE(?) OVER (ORDER BY log_time) AS tile
+              FROM catchem_9_2023.dbo.treasure_log
+              {where}) AS tiles
+        GROUP BY tile
+    """, params)
+    starts = sorted({row[0] for row in cursor_op.fetchall()})
+    if not starts:
+        return []
+
+    # The first range starts at the watermark so rows equal to it are not skipped
+    starts[0] = since if since is not None else starts[0]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def read_frame(cursor, query, columns, params=()):
+    """
+    Run a query and return its result set as a DataFrame.
+    :param cursor: cursor object to run the query on
+    :param query: SQL query
+    :param columns: column names of the result set
+    :param params: query parameters
+    :return: DataFrame with the query results
+    """
+    cursor.execute(query, params)
+    return pd.DataFrame([tuple(row) for row in cursor.fetchall()], columns=columns)
 
 
-def populate_fact_treasure_found(cursor_dwh, treasure_log_data):
+def fetch_user_map(cursor_dwh):
     """
-    Populate the 'factTreasureFound' table.
+    Read every dimUser version once, for the point-in-time resolution of DIM_USER_SK.
     :param cursor_dwh: data warehouse cursor object
+    :return: DataFrame with the hunter_id, user_SK and validity interval of every SCD version
+    """
+    return read_frame(cursor_dwh, """
+        SELECT userId, user_SK, scd_start, scd_end
+        FROM catchem_dwh.dbo.dimUser
+    """, ['hunter_id', 'user_SK', 'scd_start', 'scd_end'])
+
+
+def fetch_treasure_type_map(cursor_dwh):
+    """
+    Resolve the dimTreasureType surrogate key of every treasure once. The stage count and
+    maximum visibility are computed with one GROUP BY over treasure_stages/stage, so the
+    cost depends on the number of treasures and not on the number of logs. The key itself
+    is computed from the attributes (dwh.treasure_type_key), without reading dimTreasureType.
+    :param cursor_dwh: data warehouse cursor object
+    :return: DataFrame mapping treasure_id to treasureType_SK, NaN for treasures whose
+             attributes are outside the dimension's value ranges
+    """
+    treasures = read_frame(cursor_dwh, """
+        SELECT ts.treasure_id, t.difficulty, t.terrain, COUNT(ts.stages_id), MAX(s.visibility)
+        FROM catchem_9_2023.dbo.treasure_stages AS ts
+        JOIN catchem_9_2023.dbo.stage AS s ON ts.stages_id = s.id
+        JOIN catchem_9_2023.dbo.treasure AS t ON t.id = ts.treasure_id
+        GROUP BY ts.treasure_id, t.difficulty, t.terrain
+    """, ['treasure_id', 'difficulty', 'terrain', 'size', 'visibility'])
+
+    # Treasures outside the dimension's value ranges have no treasure type and never will
+    treasures['treasureType_SK'] = dwh.treasure_type_key(treasures)
+    return treasures[['treasure_id', 'treasureType_SK']]
+
+
+def fetch_weather_index(cursor_dwh):
+    """
+    Read the weather history once into a compact (city, date, hour) -> rain_id index.
+    :param cursor_dwh: data warehouse cursor object
+    :return: DataFrame with one row per city, date and hour
+    """
+    weather = read_frame(cursor_dwh, """
+        SELECT wc.city_id, wh.date, wh.hour, dw.rain_id
+        FROM catchem_9_2023.dbo.weather_history AS wh
+        JOIN catchem_9_2023.dbo.weather_city AS wc ON wc.city_key = wh.city_key
+        JOIN catchem_dwh.dbo.dimRain AS dw ON dw.rain_id = wh.rain_id
+        WHERE wc.city_id IS NOT NULL
+    """, ['city_id', 'weather_date', 'DIM_HOUR_SK', 'RAIN_ID'])
+
+    weather['city_id'] = weather['city_id'].astype('category')
+    weather['weather_date'] = pd.to_datetime(weather['weather_date'])
+    weather['DIM_HOUR_SK'] = weather['DIM_HOUR_SK'].astype('int8')
+    weather['RAIN_ID'] = weather['RAIN_ID'].astype('int8')
+    return weather.drop_duplicates(subset=['city_id', 'weather_date', 'DIM_HOUR_SK'])
+
+
+def fetch_day_range(cursor_dwh):
+    """
+    Read the first and last day_SK of dimDay once; the day keys are computed, not looked up,
+    so rows outside this range would break the foreign key to dimDay.
+    :param cursor_dwh: data warehouse cursor object
+    :return: tuple of the lowest and highest day_SK, (None, None) when dimDay is empty
+    :raises RuntimeError: when dimDay still has the old IDENTITY day_SK, whose keys no fact row would match
+    """
+    cursor_dwh.execute("SELECT COLUMNPROPERTY(OBJECT_ID('catchem_dwh.dbo.dimDay'), 'day_SK', 'IsIdentity')")
+    if cursor_dwh.fetchone()[0] == 1:
+        raise RuntimeError("dimDay still uses an IDENTITY day_SK instead of yyyymmdd keys; rebuild it with "
+                           "dimDay.py before loading facts.")
+    cursor_dwh.execute("SELECT MIN(day_SK), MAX(day_SK) FROM catchem_dwh.dbo.dimDay")
+    first_day, last_day = cursor_dwh.fetchone()
+    return first_day, last_day
+
+
+def fetch_unknown_rain_id(cursor_dwh):
+    """
+    Read the dimRain key used when no weather is known for a find.
+    :param cursor_dwh: data warehouse cursor object
+    :return: rain_id of the 'Unknown' category
+    """
+    cursor_dwh.execute("SELECT rain_id FROM catchem_dwh.dbo.dimRain WHERE rain_category = 'Unknown'")
+    return cursor_dwh.fetchone()[0]
+
+
+def load_dimension_maps(cursor_dwh):
+    """
+    Read every dimension lookup the fact load needs, one query per dimension.
+    :param cursor_dwh: data warehouse cursor object
+    :return: dict of lookups keyed by dimension name
+    """
+    return {
+        'user': fetch_user_map(cursor_dwh),
+        'treasure_type': fetch_treasure_type_map(cursor_dwh),
+        'weather': fetch_weather_index(cursor_dwh),
+        'day_range': fetch_day_range(cursor_dwh),
+        'unknown_rain_id': fetch_unknown_rain_id(cursor_dwh),
+    }
+
+
+def earliest(*moments):
+    """
+    Return the earliest of some optional timestamps.
+    :param moments: datetimes, None where there is none
+    :return: the earliest datetime, None when all are None
+    """
+    moments = [moment for moment in moments if moment is not None]
+    return min(moments) if moments else None
+
+
+def retry_since():
+    """
+    Return the log_time from which unresolved logs are still retried, see UNRESOLVED_RETRY_DAYS.
+    :return: datetime
+    """
+    return datetime.now() - timedelta(days=UNRESOLVED_RETRY_DAYS)
+
+
+def transform_fact_rows(treasure_log_data, dimension_maps, retry_from=None):
+    """
+    Resolve the surrogate keys of all treasure_log rows with vectorized merges.
+    Logs whose hunter has no dimUser version or whose treasure has no stages yet are left out
+    and reported, so the caller can keep the watermark from moving past them. Logs of treasures
+    whose attributes are outside dimTreasureType can never resolve; they are logged and dropped.
     :param treasure_log_data: DataFrame containing data from the 'treasure_log' table
+    :param dimension_maps: dimension lookups returned by load_dimension_maps
+    :param retry_from: unresolved logs older than this are given up on instead of reported, never when None
+    :return: tuple of a DataFrame with the FACT_COLUMNS of the rows to insert and the log_time
+             of the oldest unresolved log (None when all resolved)
+    """
+    facts = treasure_log_data.copy()
+    facts['log_time'] = pd.to_datetime(facts['log_time'])
+    facts['session_start'] = pd.to_datetime(facts['session_start'])
+
+    facts['Duration'] = (facts['log_time'] - facts['session_start']).dt.total_seconds()
+    facts = facts.dropna(subset=['Duration'])
+    facts['Duration'] = facts['Duration'].astype(int)
+
+    # One fact row per log: the dimUser version that was valid when the treasure was found
+    facts['user_SK'] = dwh.resolve_scd_keys(facts, dimension_maps['user'], 'hunter_id', 'log_time', 'user_SK')
+    treasure_types = dimension_maps['treasure_type']
+    known_treasure = facts['treasure_id'].isin(treasure_types['treasure_id'])
+    typed_treasure = facts['treasure_id'].isin(treasure_types.loc[treasure_types['treasureType_SK'].notna(), 'treasure_id'])
+    invalid_type = known_treasure & ~typed_treasure
+    if invalid_type.any():
+        logging.warning(f"Skipped {invalid_type.sum()} treasure_log rows whose treasure has attributes "
+                        f"outside dimTreasureType.")
+    resolved = facts['user_SK'].notna() & typed_treasure
+
+    # The dimensions may still catch up with these logs: a hunter without a dimUser version yet or a
+    # treasure without stages yet. Logs without a hunter or treasure, or with an invalid type, never will
+    unresolved = ((facts['user_SK'].isna() & facts['hunter_id'].notna())
+                  | (~known_treasure & facts['treasure_id'].notna())) & ~invalid_type
+    if retry_from is not None:
+        given_up = unresolved & (facts['log_time'] < retry_from)
+        if given_up.any():
+            logging.warning(f"Gave up on {given_up.sum()} treasure_log rows older than {retry_from} "
+                            f"whose hunter or treasure type is still unknown.")
+        unresolved &= ~given_up
+    oldest_unresolved = facts.loc[unresolved, 'log_time'].min().to_pydatetime() if unresolved.any() else None
+
+    facts = facts[resolved].copy()
+    facts['user_SK'] = facts['user_SK'].astype(int)
+    facts = facts.merge(treasure_types, on='treasure_id')
+    facts['treasureType_SK'] = facts['treasureType_SK'].astype(int)
+
+    # dimDay and dimHour keys are computed from the timestamps, no lookup needed; days dimDay
+    # doesn't cover are dropped so one such row can't fail the whole load on the foreign key
+    facts['DIM_DAY_SK'] = dwh.date_key(facts['session_start'])
+    first_day, last_day = dimension_maps['day_range']
+    in_dim_day = facts['DIM_DAY_SK'].between(first_day, last_day) if first_day is not None \
+        else pd.Series(False, index=facts.index)
+    if not in_dim_day.all():
+        logging.warning(f"Skipped {(~in_dim_day).sum()} treasure_log rows whose session_start is outside "
+                        f"dimDay ({first_day}-{last_day}).")
+        facts = facts[in_dim_day].copy()
+    facts['DIM_HOUR_SK'] = dwh.hour_key(facts['log_time']).astype('int8')
+
+    # Weather at the city, date and hour of the find; finds outside the weather history are 'Unknown'
+    facts['weather_date'] = facts['log_time'].dt.normalize()
+    facts = facts.merge(dimension_maps['weather'], on=['city_id', 'weather_date', 'DIM_HOUR_SK'], how='left')
+    facts['RAIN_ID'] = facts['RAIN_ID'].fillna(dimension_maps['unknown_rain_id']).astype(int)
+    facts['DIM_HOUR_SK'] = facts['DIM_HOUR_SK'].astype(int)
+
+    facts = facts.rename(columns={'id': 'TreasureLogID', 'user_SK': 'DIM_USER_SK',
+                                  'treasureType_SK': 'DIM_TREASURE_TYPE_SK'})
+    return facts[FACT_COLUMNS], oldest_unresolved
+
+
+def write_fact_rows(cursor_dwh, fact_rows):
+    """
+    Bulk insert fact rows into a staging table and copy the logs that are not in
+    'factTreasureFound' yet. Nothing is committed here.
+    :param cursor_dwh: data warehouse cursor object
+    :param fact_rows: DataFrame with the FACT_COLUMNS, as returned by transform_fact_rows
+    :return: number of rows inserted into 'factTreasureFound'
+    """
+    cursor_dwh.execute("""
+        IF OBJECT_ID('tempdb..#factTreasureFound_stage') IS NOT NULL DROP TABLE #factTreasureFound_stage;
+        CREATE TABLE #factTreasureFound_stage (
+            TreasureLogID BINARY(16) NOT NULL PRIMARY KEY,
+            DIM_USER_SK INT, DIM_TREASURE_TYPE_SK INT, DIM_DAY_SK INT, DIM_HOUR_SK INT,
+            RAIN_ID INT, Duration INT
+        )
+    """)
+
+    # The caller commits the staged rows together with the watermark
+    with dwh.BulkWriter(cursor_dwh, '#factTreasureFound_stage', FACT_COLUMNS, commit_every=0,
+                        label='factTreasureFound stage') as writer:
+        writer.write_frame(fact_rows)
+
+    cursor_dwh.execute("""
+        INSERT INTO catchem_dwh.dbo.factTreasureFound(TreasureLogID, DIM_USER_SK, DIM_TREASURE_TYPE_SK, DIM_DAY_SK, DIM_HOUR_SK, RAIN_ID, Duration, CreationDate, Constant)
+        SELECT s.TreasureLogID, s.DIM_USER_SK, s.DIM_TREASURE_TYPE_SK, s.DIM_DAY_SK, s.DIM_HOUR_SK, s.RAIN_ID, s.Duration, GETDATE(), 1
+        FROM #factTreasureFound_stage AS s
+        WHERE NOT EXISTS (SELECT 1 FROM catchem_dwh.dbo.factTreasureFound AS f WHERE f.TreasureLogID = s.TreasureLogID)
+    """)
+    return cursor_dwh.rowcount
+
+
+def populate_fact_treasure_found(cursor_dwh, treasure_log_data, dimension_maps=None):
+    """
+    Populate the 'factTreasureFound' table. Dimensions are read once, keys are resolved
+    in memory and the fact rows are bulk inserted chunk by chunk. Everything, including
+    the watermark, is committed in one transaction. The watermark moves to the newest
+    log_time, or only up to the oldest log still waiting for its dimUser version or treasure type.
+    :param cursor_dwh: data warehouse cursor object
+    :param treasure_log_data: DataFrame, or iterable of DataFrame chunks, of 'treasure_log' rows
+    :param dimension_maps: dimension lookups returned by load_dimension_maps, read when omitted
     :return: None
     """
+    if isinstance(treasure_log_data, pd.DataFrame):
+        treasure_log_data = [treasure_log_data]
+
     try:
-        for index, row in treasure_log_data.iterrows():
-            # Get user_ids from dimUser table for the given hunter_id
-            cursor_dwh.execute("""
-                SELECT user_SK
-                FROM catchem_dwh.dbo.dimUser
-                WHERE userId = ?
-            """, (row['hunter_id'],))
-            user_rows = cursor_dwh.fetchall()
-
-            if user_rows:
-                for user_row in user_rows:
-                    if user_row:
-                        user_sk = user_row[0]
-                    else:
-                        continue
-
-                    # Get TreasureTypeID from 'dimTreasureType' table
-                    cursor_dwh.execute("""
-                        SELECT tt.treasureType_SK
-                        FROM catchem_9_2023.dbo.treasure AS t
-                        JOIN catchem_9_2023.dbo.treasure_stages AS ts ON t.id = ts.treasure_id
-                        JOIN catchem_9_2023.dbo.stage AS s ON ts.stages_id = s.id
-                        JOIN catchem_dwh.dbo.dimTreasureType AS tt ON t.difficulty = tt.difficulty
-                            AND t.terrain = tt.terrain
-                            AND (SELECT COUNT(sts.stages_id)
-                                 FROM catchem_9_2023.dbo.treasure_stages AS sts
-                                 WHERE sts.treasure_id = t.id) = tt.size
-                            AND (SELECT MAX(st.visibility)
-                                 FROM catchem_9_2023.dbo.treasure_stages AS sts
-                                      JOIN catchem_9_2023.dbo.stage AS st ON sts.stages_id = st.id
-                                 WHERE sts.treasure_id = t.id) = tt.visibility
-                        WHERE t.id = ?;
-                    """, (row['treasure_id'],))
-                    treasure_type_row = cursor_dwh.fetchone()
-                    if treasure_type_row:
-                        treasure_type_sk = treasure_type_row[0]
-                    else:
-                        continue
-
-                    # Get DateID from 'dimDate' table
-                    cursor_dwh.execute("""
-                        SELECT day_SK
-                        FROM catchem_dwh.dbo.dimDay
-                        WHERE CAST(Date AS DATE) = CAST(? AS DATE)
-                    """, (row['session_start'],))
-                    date_row = cursor_dwh.fetchone()
-                    if date_row:
-                        date_sk = date_row[0]
-                    else:
-                        continue
-
-                    # Get WeatherId from 'dimWeather' table
-                    cursor_dwh.execute("""
-                        SELECT dw.rain_id
-                        FROM catchem_dwh.dbo.dimRain AS dw
-                        JOIN catchem_9_2023.dbo.weather_history AS wh ON dw.rain_category = wh.weather_type
-                        WHERE DATEPART(HOUR, wh.hour) = DATEPART(HOUR, ?);
-                    """, (row['log_time'],))
-                    weather_row = cursor_dwh.fetchone()
-                    if weather_row:
-                        weather_sk = weather_row[0]
-                    else:
-                        continue
-
-                    logging.info(f"Log Time: {row['log_time']}")
-
-                    # Insert data into 'factTreasureFound' table
-                    try:
-                        duration = (row['log_time'] - row['session_start']).total_seconds()
-                        cursor_dwh.execute("""
-                           INSERT INTO catchem_dwh.dbo.factTreasureFound(DIM_USER_SK, DIM_TREASURE_TYPE_SK, DIM_DAY_SK, RAIN_ID, Duration, CreationDate, Constant)
-VALUES (?, ?, ?, ?, ?, GETDATE(), 1)
-
-                        """, (user_sk, treasure_type_sk, date_sk, weather_sk, int(duration)))
-                        logging.info(f"Inserted data into factTreasureFound table for hunter_id: {row['hunter_id']}")
-                        cursor_dwh.commit()
-
-                    except pyodbc.Error as e:
-                        logging.error(f"Error inserting data into factTreasureFound table: {e}")
-
-            else:
-                continue
+        if dimension_maps is None:
+            dimension_maps = load_dimension_maps(cursor_dwh)
+
+        read = inserted = 0
+        newest = oldest_unresolved = None
+        retry_from = retry_since()
+        for chunk in treasure_log_data:
+            fact_rows, chunk_unresolved = transform_fact_rows(chunk, dimension_maps, retry_from)
+            inserted += write_fact_rows(cursor_dwh, fact_rows)
+            read += len(chunk)
+            chunk_newest = pd.to_datetime(chunk['log_time']).max().to_pydatetime()
+            newest = chunk_newest if newest is None else max(newest, chunk_newest)
+            oldest_unresolved = earliest(oldest_unresolved, chunk_unresolved)
+
+        if newest is None:
+            logging.info("No new data in treasure_log table, nothing to load.")
+            return
+
+        watermark = earliest(newest, oldest_unresolved)
+        if watermark < newest:
+            logging.info(f"Holding the watermark at {watermark}: logs from then on wait for their "
+                         f"dimUser version or treasure type and are retried by the next load.")
+        dwh.set_watermark(cursor_dwh, WATERMARK_SOURCE, watermark)
+        cursor_dwh.commit()
+        logging.info(f"Inserted {inserted} new rows into factTreasureFound from {read} treasure_log rows.")
 
     except pyodbc.Error as e:
+        cursor_dwh.rollback()
         logging.error(f"Error populating fact_treasure_found table: {e}")
 
 
+# Per-process state of the parallel load workers
+_worker = {}
+
+
+def _init_worker(dimension_maps):
+    """
+    Process pool initializer: keep the shared dimension maps and open this worker's own connections.
+    :param dimension_maps: dimension lookups returned by load_dimension_maps
+    :return: None
+    """
+    _worker['dimension_maps'] = dimension_maps
+    _worker['conn_op'] = dwh.establish_connection(SERVER, DATABASE_OP, USERNAME, PASSWORD, DRIVER)
+    _worker['conn_dwh'] = dwh.establish_connection(SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER)
+
+
+def _load_partition(bounds, retry_from):
+    """
+    Extract, transform and load one log_time range in a worker process and commit it.
+    :param bounds: (since, until) log_time range from fetch_partition_bounds
+    :param retry_from: unresolved logs older than this are given up on, see transform_fact_rows
+    :return: tuple of (treasure_log rows read, fact rows inserted, newest log_time or None,
+             oldest unresolved log_time or None)
+    """
+    cursor_dwh = _worker['conn_dwh'].cursor()
+    read = inserted = 0
+    newest = oldest_unresolved = None
+    try:
+        for chunk in iter_treasure_log_data(_worker['conn_op'].cursor(), *bounds):
+            fact_rows, chunk_unresolved = transform_fact_rows(chunk, _worker['dimension_maps'], retry_from)
+            inserted += write_fact_rows(cursor_dwh, fact_rows)
+            read += len(chunk)
+            chunk_newest = pd.to_datetime(chunk['log_time']).max().to_pydatetime()
+            newest = chunk_newest if newest is None else max(newest, chunk_newest)
+            oldest_unresolved = earliest(oldest_unresolved, chunk_unresolved)
+        cursor_dwh.commit()
+    except Exception:
+        # Roll back so the next range on this worker's connection doesn't commit a half-loaded one
+        cursor_dwh.rollback()
+        raise
+    return read, inserted, newest, oldest_unresolved
+
+
+def populate_fact_treasure_found_parallel(cursor_op, cursor_dwh, workers, since=None):
+    """
+    Populate the 'factTreasureFound' table with a pool of worker processes. The logs since
+    the watermark are split into log_time ranges and every worker loads ranges with its own
+    connections, sharing the dimension maps read once here. The watermark only moves when
+    every range loaded, and not past the oldest log still waiting for its dimensions; ranges
+    that did load are skipped by the degenerate key on a rerun.
+    :param cursor_op: operational database cursor object
+    :param cursor_dwh: data warehouse cursor object
+    :param workers: number of worker processes
+    :param since: only load logs from this log_time on, all logs when None
+    :return: None
+    """
+    # A few ranges per worker keeps all workers busy when ranges differ in cost
+    partitions = fetch_partition_bounds(cursor_op, workers * 4, since)
+    if not partitions:
+        logging.info("No new data in treasure_log table, nothing to load.")
+        return
+
+    dimension_maps = load_dimension_maps(cursor_dwh)
+    started = time.perf_counter()
+    read = inserted = 0
+    newest = []
+    oldest_unresolved = None
+    failed = 0
+    retry_from = retry_since()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dimension_maps,)) as pool:
+        futures = {pool.submit(_load_partition, bounds, retry_from): bounds for bounds in partitions}
+        for future in as_completed(futures):
+            try:
+                rows_read, rows_inserted, newest_log_time, unresolved_log_time = future.result()
+            except Exception as e:
+                # A broken pool or a transform error fails the range, not the whole load
+                failed += 1
+                logging.error(f"Error loading treasure_log range {futures[future]}: {e}")
+                continue
+            read += rows_read
+            inserted += rows_inserted
+            if newest_log_time is not None:
+                newest.append(newest_log_time)
+            oldest_unresolved = earliest(oldest_unresolved, unresolved_log_time)
+
+    elapsed = time.perf_counter() - started
+    logging.info(f"Inserted {inserted} new rows into factTreasureFound from {read} treasure_log rows "
+                 f"with {workers} workers in {elapsed:.1f}s.")
+
+    if failed:
+        logging.error(f"{failed} of {len(partitions)} ranges failed, the watermark was not moved.")
+    elif newest:
+        watermark = earliest(max(newest), oldest_unresolved)
+        if watermark < max(newest):
+            logging.info(f"Holding the watermark at {watermark}: logs from then on wait for their "
+                         f"dimUser version or treasure type and are retried by the next load.")
+        dwh.set_watermark(cursor_dwh, WATERMARK_SOURCE, watermark)
+        cursor_dwh.commit()
+
+
 def empty_fact_treasure_found(cursor_dwh):
     """
     Empty the 'factTreasureFound' table.
@@ -181,9 +606,12 @@ def empty_fact_treasure_found(cursor_dwh):
         logging.error("Error encountered while emptying the 'factTreasureFound' table: Unable to truncate table.")
 
 
-def main():
+def main(full_reload=False, workers=FACT_LOAD_WORKERS):
     """
-    Main function.
+    Main function. Loads the treasure_log rows newer than the stored watermark,
+    or drops the fact table and reloads everything when full_reload is set
+    (python FactTreasureFound.py --full-reload). A table of the layout before TreasureLogID
+    is rebuilt the same way. With more than one worker the load is split over a pool of processes.
     """
     try:
         # Establish connections to the databases
@@ -192,21 +620,28 @@ def main():
         conn_op = dwh.establish_connection(SERVER, DATABASE_OP, USERNAME, PASSWORD, DRIVER)
         cursor_op = conn_op.cursor()
 
-        # Create the 'factTreasureFound' table
+        # Create the 'factTreasureFound' table and the watermark table
+        dwh.create_watermark_table(cursor_dwh)
+        if not full_reload and has_old_layout(cursor_dwh):
+            logging.warning("factTreasureFound has no TreasureLogID column yet, rebuilding it with a full reload.")
+            full_reload = True
+        if full_reload:
+            drop_table(cursor_dwh)
         create_table(cursor_dwh)
-        print(f"create fact table successfully")
-
-        # Empty the 'factTreasureFound' table
-        empty_fact_treasure_found(cursor_dwh)
 
-        # Fetch data from the 'treasure_log' table
-        treasure_log_data = fetch_treasure_log_data(cursor_op)
+        # Fetch the 'treasure_log' rows since the last successful load
+        since = dwh.get_watermark(cursor_dwh, WATERMARK_SOURCE)
+        logging.info(f"Loading treasure_log rows since: {since}")
 
         # Populate the 'factTreasureFound' table
-        if not treasure_log_data.empty:
-            populate_fact_treasure_found(cursor_dwh, treasure_log_data)
+        if workers > 1:
+            populate_fact_treasure_found_parallel(cursor_op, cursor_dwh, workers, since)
         else:
-            logging.warning("No data fetched from treasure_log table, skipping population.")
+            populate_fact_treasure_found(cursor_dwh, iter_treasure_log_data(cursor_op, since))
+
+        # Add the newly loaded rows to the aggregate tables
+        aggregates.create_aggregate_tables(cursor_dwh)
+        aggregates.refresh_aggregates(cursor_dwh)
 
         # Close the connections
         cursor_op.close()
@@ -219,4 +654,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    main(full_reload='--full-reload' in sys.argv)
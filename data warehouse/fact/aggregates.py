@@ -0,0 +1,211 @@
+import logging
+
+import pandas as pd
+import pyodbc
+
+import dwh as dwh
+from config import SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER
+
+logging.basicConfig(level=logging.INFO)
+
+# Name of the aggregate refresh in the etl_watermark table; its change_version is the last aggregated TreasureFoundID
+WATERMARK_SOURCE = 'factTreasureFound_aggregates'
+
+# Summary tables of factTreasureFound and the fact columns they are grouped by. They store counts
+# and duration sums (not averages), so the rows of a new load can simply be added.
+AGGREGATES = {
+    'agg_found_treasure_type_day': ['DIM_TREASURE_TYPE_SK', 'DIM_DAY_SK', 'RAIN_ID'],
+    'agg_found_user_treasure_type': ['DIM_USER_SK', 'DIM_TREASURE_TYPE_SK'],
+}
+
+# The business questions of queries.sql, answered from the aggregates
+QUESTIONS = {
+    # S1: Are more difficult caches done on weekends?
+    'difficulty_by_weekday': """
+        SELECT tt.difficulty, dd.Weekday, SUM(a.found_count) AS total_caches_searched
+        FROM catchem_dwh.dbo.agg_found_treasure_type_day a
+        JOIN catchem_dwh.dbo.dimTreasureType tt ON a.DIM_TREASURE_TYPE_SK = tt.treasureType_SK
+        JOIN catchem_dwh.dbo.dimDay dd ON a.DIM_DAY_SK = dd.day_SK
+        GROUP BY tt.difficulty, dd.Weekday
+        ORDER BY tt.difficulty, dd.Weekday
+    """,
+    # S1: Are fewer caches searched in more difficult terrain when it rains?
+    'difficulty_in_rain': """
+        SELECT tt.difficulty, SUM(a.found_count) AS total_caches_searched
+        FROM catchem_dwh.dbo.agg_found_treasure_type_day a
+        JOIN catchem_dwh.dbo.dimTreasureType tt ON a.DIM_TREASURE_TYPE_SK = tt.treasureType_SK
+        JOIN catchem_dwh.dbo.dimRain dr ON a.RAIN_ID = dr.rain_id
+        WHERE dr.rain_category = 'With Rain'
+        GROUP BY tt.difficulty
+        ORDER BY tt.difficulty
+    """,
+    # S1: What role do date parameters have on the number of caches?
+    'finds_by_date': """
+        SELECT dd.DayOfMonth, dd.Weekday, dd.MonthName, dd.Season, SUM(a.found_count) AS total_caches_searched
+        FROM catchem_dwh.dbo.agg_found_treasure_type_day a
+        JOIN catchem_dwh.dbo.dimDay dd ON a.DIM_DAY_SK = dd.day_SK
+        GROUP BY dd.DayOfMonth, dd.Weekday, dd.MonthName, dd.Season
+        ORDER BY dd.DayOfMonth, dd.MonthName, dd.Season
+    """,
+    # S2: How does the type of user affect the duration of the treasure hunt?
+    'duration_by_experience': """
+        SELECT u.experience_level, SUM(a.duration_sum) / SUM(a.found_count) AS average_duration
+        FROM catchem_dwh.dbo.agg_found_user_treasure_type a
+        JOIN catchem_dwh.dbo.dimUser u ON a.DIM_USER_SK = u.user_SK
+        GROUP BY u.experience_level
+    """,
+    # S2: On average, do users find the cache faster in the rain?
+    'duration_by_rain': """
+        SELECT dr.rain_category, SUM(a.duration_sum) / SUM(a.found_count) AS AvgTreasureFound
+        FROM catchem_dwh.dbo.agg_found_treasure_type_day a
+        JOIN catchem_dwh.dbo.dimRain dr ON a.RAIN_ID = dr.rain_id
+        GROUP BY dr.rain_category
+        ORDER BY dr.rain_category
+    """,
+    # S2: Are novice users on average looking for caches with more stages?
+    'stages_by_experience': """
+        SELECT u.experience_level, SUM(tt.size * a.found_count) / SUM(a.found_count) AS average_num_stages
+        FROM catchem_dwh.dbo.agg_found_user_treasure_type a
+        JOIN catchem_dwh.dbo.dimUser u ON a.DIM_USER_SK = u.user_SK
+        JOIN catchem_dwh.dbo.dimTreasureType tt ON a.DIM_TREASURE_TYPE_SK = tt.treasureType_SK
+        GROUP BY u.experience_level
+    """,
+    # Does the hidden stage visibility make it challenging to find caches even for professionals?
+    'visibility_for_professionals': """
+        SELECT tt.visibility, SUM(a.found_count) AS FoundCount
+        FROM catchem_dwh.dbo.agg_found_user_treasure_type a
+        JOIN catchem_dwh.dbo.dimUser u ON a.DIM_USER_SK = u.user_SK
+        JOIN catchem_dwh.dbo.dimTreasureType tt ON a.DIM_TREASURE_TYPE_SK = tt.treasureType_SK
+        WHERE u.experience_level = 'Professional'
+        GROUP BY tt.visibility
+        ORDER BY FoundCount DESC
+    """,
+    # Does the number of catches differ for different countries?
+    'finds_by_country': """
+        SELECT RIGHT(u.address, CHARINDEX(' ', REVERSE(u.address)) - 1) AS Country, SUM(a.found_count) AS FoundCount
+        FROM catchem_dwh.dbo.agg_found_user_treasure_type a
+        JOIN catchem_dwh.dbo.dimUser u ON a.DIM_USER_SK = u.user_SK
+        GROUP BY RIGHT(u.address, CHARINDEX(' ', REVERSE(u.address)) - 1)
+        ORDER BY FoundCount DESC
+    """,
+    # Which caches are most popular based on difficulty level?
+    'finds_by_difficulty': """
+        SELECT tt.difficulty, SUM(a.found_count) AS FoundCount
+        FROM catchem_dwh.dbo.agg_found_treasure_type_day a
+        JOIN catchem_dwh.dbo.dimTreasureType tt ON a.DIM_TREASURE_TYPE_SK = tt.treasureType_SK
+        GROUP BY tt.difficulty
+        ORDER BY FoundCount DESC
+    """,
+}
+
+
+def create_aggregate_tables(cursor_dwh):
+    """
+    Create the summary tables of factTreasureFound if they don't exist.
+    :param cursor_dwh: Data warehouse cursor object
+    :return: None
+    """
+    try:
+        for table, keys in AGGREGATES.items():
+            key_columns = ",\n                ".join(f"{key} INT NOT NULL" for key in keys)
+            cursor_dwh.execute(f"""
+            IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '{table}')
+            BEGIN
+              CREATE TABLE catchem_dwh.dbo.{table} (
+                {key_columns},
+                found_count INT NOT NULL,
+                duration_sum BIGINT NOT NULL,
+                PRIMARY KEY ({", ".join(keys)})
+              )
+            END
+            """)
+        cursor_dwh.commit()
+        logging.info("Aggregate tables created successfully or already exist.")
+    except pyodbc.Error as e:
+        logging.error(f"Error creating aggregate tables: {e}")
+
+
+def refresh_aggregates(cursor_dwh):
+    """
+    Add the fact rows loaded since the last refresh to the summary tables. Only the rows with a
+    TreasureFoundID above the stored one are aggregated; all tables and the watermark are updated
+    in one transaction. Run it after a fact load has finished, not while loads are still inserting.
+    :param cursor_dwh: Data warehouse cursor object
+    :return: the newest TreasureFoundID aggregated, 0 when there was nothing new
+    """
+    last_fact_id = dwh.get_change_version(cursor_dwh, WATERMARK_SOURCE) or 0
+    cursor_dwh.execute("SELECT MAX(TreasureFoundID) FROM catchem_dwh.dbo.factTreasureFound")
+    newest_fact_id = cursor_dwh.fetchone()[0]
+    if newest_fact_id is None or newest_fact_id <= last_fact_id:
+        logging.info("Aggregates are up to date.")
+        return 0
+
+    try:
+        for table, keys in AGGREGATES.items():
+            key_list = ", ".join(keys)
+            cursor_dwh.execute(f"""
+            MERGE catchem_dwh.dbo.{table} AS a
+            USING (
+                SELECT {key_list}, COUNT(*) AS found_count, ISNULL(SUM(CAST(Duration AS BIGINT)), 0) AS duration_sum
+                FROM catchem_dwh.dbo.factTreasureFound
+                WHERE TreasureFoundID > ? AND TreasureFoundID <= ?
+                  AND {" AND ".join(f"{key} IS NOT NULL" for key in keys)}
+                GROUP BY {key_list}
+            ) AS n ON {" AND ".join(f"a.{key} = n.{key}" for key in keys)}
+            WHEN MATCHED THEN UPDATE SET
+                found_count = a.found_count + n.found_count,
+                duration_sum = a.duration_sum + n.duration_sum
+            WHEN NOT MATCHED THEN INSERT ({key_list}, found_count, duration_sum)
+                VALUES ({", ".join(f"n.{key}" for key in keys)}, n.found_count, n.duration_sum);
+            """, (last_fact_id, newest_fact_id))
+        dwh.set_change_version(cursor_dwh, WATERMARK_SOURCE, newest_fact_id)
+        cursor_dwh.commit()
+    except pyodbc.Error:
+        cursor_dwh.rollback()
+        raise
+
+    logging.info(f"Aggregated the fact rows with TreasureFoundID {last_fact_id + 1}-{newest_fact_id}.")
+    return newest_fact_id
+
+
+def reset_aggregates(cursor_dwh):
+    """
+    Empty the summary tables and forget the refresh watermark, for a full reload of the fact table.
+    :param cursor_dwh: Data warehouse cursor object
+    :return: None
+    """
+    for table in AGGREGATES:
+        cursor_dwh.execute(f"IF OBJECT_ID('catchem_dwh.dbo.{table}') IS NOT NULL TRUNCATE TABLE catchem_dwh.dbo.{table}")
+    cursor_dwh.execute("DELETE FROM etl_watermark WHERE source_name = ?", (WATERMARK_SOURCE,))
+    cursor_dwh.commit()
+
+
+def answer(cursor_dwh, question):
+    """
+    Answer one of the business questions from the summary tables.
+    :param cursor_dwh: Data warehouse cursor object
+    :param question: a key of QUESTIONS, e.g. 'duration_by_rain'
+    :return: DataFrame with the answer
+    """
+    cursor_dwh.execute(QUESTIONS[question])
+    columns = [column[0] for column in cursor_dwh.description]
+    return pd.DataFrame([tuple(row) for row in cursor_dwh.fetchall()], columns=columns)
+
+
+def main():
+    conn_dwh = dwh.establish_connection(SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER)
+    cursor_dwh = conn_dwh.cursor()
+
+    dwh.create_watermark_table(cursor_dwh)
+    create_aggregate_tables(cursor_dwh)
+    refresh_aggregates(cursor_dwh)
+
+    for question in QUESTIONS:
+        logging.info(f"{question}:\n{answer(cursor_dwh, question)}")
+
+    cursor_dwh.close()
+    conn_dwh.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,3 +9,9 @@ DATABASE_DWH = 'catchem_dwh'
 DRIVER = '{ODBC Driver 17 for SQL Server}'
 
 
+# Worker processes used by the factTreasureFound load (1 = load serially)
+FACT_LOAD_WORKERS = 1
+
+# Physical design of factTreasureFound (only applied when the table is created)
+FACT_COLUMNSTORE = False
+FACT_PARTITION_BY_DAY = False
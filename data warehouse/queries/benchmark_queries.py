@@ -0,0 +1,289 @@
+"""
+Benchmarks the queries in queries.sql against the data warehouse.
+
+Every query runs with STATISTICS IO, TIME and XML on; its elapsed and CPU time, logical reads,
+row count and actual XML plan are stored per run in query_benchmark_run / query_benchmark_result.
+Run it once before and once after a physical design change (an index, the indexed view of
+dimTreasureType.py --indexed-view, the columnstore of factTreasureFound) and compare the two runs:
+
+    python benchmark_queries.py --label "before columnstore"
+    python benchmark_queries.py --label "after columnstore"
+    python benchmark_queries.py --compare 1 2
+
+Uses the config.py and dwh.py of 'data warehouse/fact' (put that folder on PYTHONPATH).
+"""
+import argparse
+import hashlib
+import os
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+
+import pyodbc
+
+from config import SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER
+from dwh import establish_connection
+
+QUERIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'queries.sql')
+
+# A query counts as regressed when its logical reads, CPU time or plan cost grow by more than this
+REGRESSION_THRESHOLD = 0.2
+
+# Timings below this many milliseconds are noise and never flagged
+MIN_FLAGGED_MS = 10
+
+SHOWPLAN_NAMESPACE = '{http://schemas.microsoft.com/sqlserver/2004/07/showplan}'
+
+LOGICAL_READS = re.compile(r"logical reads (\d+)")
+EXECUTION_TIME = re.compile(r"SQL Server Execution Times:\s*CPU time = (\d+) ms,\s*elapsed time = (\d+) ms")
+
+
+def read_queries(path=QUERIES_FILE):
+    """
+    Splits queries.sql into its SELECT statements. Each query is named after the comment
+    line right above it, or numbered when there is none.
+    Args:
+        path (str): The SQL file.
+    Returns:
+        list: (name, sql) tuples in file order.
+    """
+    queries = []
+    name, lines = None, []
+    with open(path, encoding='utf-8') as sql_file:
+        for line in sql_file:
+            stripped = line.strip()
+            if stripped.startswith('--'):
+                if not lines and stripped.strip('- '):
+                    name = stripped.strip('- ')
+                continue
+            code = line.split('--', 1)[0]
+            if code.strip():
+                lines.append(code.rstrip())
+            if code.rstrip().endswith(';'):
+                statement = "\n".join(lines).strip().rstrip(';')
+                if statement.upper().startswith(('SELECT', 'WITH')):
+                    queries.append((name or f"query {len(queries) + 1}", statement))
+                name, lines = None, []
+    return queries
+
+
+def create_benchmark_tables(cursor_dwh):
+    """
+    Creates the tables the benchmark runs and their per-query results are stored in.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+    """
+    cursor_dwh.execute("""
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'query_benchmark_run')
+    BEGIN
+        CREATE TABLE query_benchmark_run (
+            run_id INT IDENTITY(1,1) PRIMARY KEY,
+            label NVARCHAR(255) NULL,
+            started_at DATETIME2 NOT NULL DEFAULT SYSDATETIME()
+        )
+    END
+
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'query_benchmark_result')
+    BEGIN
+        CREATE TABLE query_benchmark_result (
+            run_id INT NOT NULL REFERENCES query_benchmark_run (run_id),
+            query_no INT NOT NULL,
+            query_name NVARCHAR(400) NOT NULL,
+            query_hash BINARY(16) NOT NULL,   -- md5 of the query text, matches queries across runs
+            elapsed_ms INT NULL,
+            cpu_ms INT NULL,
+            logical_reads BIGINT NULL,
+            row_count INT NULL,
+            plan_cost FLOAT NULL,
+            plan_hash NVARCHAR(32) NULL,
+            plan_xml XML NULL,
+            error NVARCHAR(MAX) NULL,
+            PRIMARY KEY (run_id, query_no)
+        )
+    END
+    """)
+    cursor_dwh.commit()
+
+
+def parse_plan(plan_xml):
+    """
+    Reads the estimated cost and the plan hash of the statement from an XML showplan.
+    Args:
+        plan_xml (str): The showplan returned by SET STATISTICS XML ON.
+    Returns:
+        tuple: (estimated subtree cost, query plan hash); None for what the plan doesn't contain.
+    """
+    statement = ElementTree.fromstring(plan_xml).find(f'.//{SHOWPLAN_NAMESPACE}StmtSimple')
+    if statement is None:
+        return None, None
+    cost = statement.get('StatementSubTreeCost')
+    return (float(cost) if cost is not None else None), statement.get('QueryPlanHash')
+
+
+def measure_query(cursor, sql):
+    """
+    Runs one query with STATISTICS IO/TIME/XML on and collects what the server reports.
+    Args:
+        cursor (pyodbc.Cursor): A cursor on the data warehouse with the statistics options set.
+        sql (str): The query.
+    Returns:
+        dict: elapsed_ms, cpu_ms, logical_reads, row_count, plan_xml, plan_cost and plan_hash.
+    """
+    started = time.perf_counter()
+    cursor.execute(sql)
+    messages = list(cursor.messages)
+    row_count, plan_xml = 0, None
+    while True:
+        if cursor.description is not None:
+            rows = cursor.fetchall()
+            if cursor.description[0][0].endswith('XML Showplan'):
+                plan_xml = rows[0][0] if rows else None
+            else:
+                row_count += len(rows)
+        if not cursor.nextset():
+            break
+        messages.extend(cursor.messages)
+    wall_ms = (time.perf_counter() - started) * 1000
+
+    text = "\n".join(str(message[1]) for message in messages)
+    timings = EXECUTION_TIME.findall(text)
+    plan_cost, plan_hash = parse_plan(plan_xml) if plan_xml else (None, None)
+    return {
+        'elapsed_ms': sum(int(elapsed) for _, elapsed in timings) if timings else round(wall_ms),
+        'cpu_ms': sum(int(cpu) for cpu, _ in timings) if timings else None,
+        'logical_reads': sum(int(reads) for reads in LOGICAL_READS.findall(text)),
+        'row_count': row_count,
+        'plan_xml': plan_xml,
+        'plan_cost': plan_cost,
+        'plan_hash': plan_hash,
+    }
+
+
+def run_benchmark(cursor_dwh, label=None, repeat=3, path=QUERIES_FILE):
+    """
+    Runs every query of queries.sql and stores the results as a new benchmark run. Each query
+    runs repeat times and the fastest run is kept, so a cold cache doesn't count as a regression.
+    The STATISTICS options apply to a whole session, so the queries are measured on a connection
+    of their own and the bookkeeping INSERTs on cursor_dwh don't produce showplans or statistics.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        label (str, optional): What this run measures, e.g. 'before indexed view'.
+        repeat (int): The number of executions per query.
+        path (str): The SQL file with the queries.
+    Returns:
+        int: The run_id of the stored run.
+    """
+    create_benchmark_tables(cursor_dwh)
+    cursor_dwh.execute("INSERT INTO query_benchmark_run (label) OUTPUT INSERTED.run_id VALUES (?)", (label,))
+    run_id = cursor_dwh.fetchone()[0]
+    cursor_dwh.commit()
+
+    conn_measure = establish_connection(SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER)
+    measure_cursor = conn_measure.cursor()
+    measure_cursor.execute("SET STATISTICS IO ON; SET STATISTICS TIME ON; SET STATISTICS XML ON;")
+    for query_no, (name, sql) in enumerate(read_queries(path), start=1):
+        query_hash = hashlib.md5(sql.encode('utf-8')).digest()
+        try:
+            result = min((measure_query(measure_cursor, sql) for _ in range(repeat)),
+                         key=lambda measured: measured['elapsed_ms'])
+            error = None
+        except pyodbc.Error as e:
+            result, error = {}, str(e)
+        cursor_dwh.execute("""
+            INSERT INTO query_benchmark_result (run_id, query_no, query_name, query_hash, elapsed_ms, cpu_ms,
+                                                logical_reads, row_count, plan_cost, plan_hash, plan_xml, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (run_id, query_no, name[:400], query_hash, result.get('elapsed_ms'), result.get('cpu_ms'),
+              result.get('logical_reads'), result.get('row_count'), result.get('plan_cost'),
+              result.get('plan_hash'), result.get('plan_xml'), error))
+        cursor_dwh.commit()
+        if error:
+            print(f"[{query_no}] {name}: failed: {error}")
+        else:
+            print(f"[{query_no}] {name}: {result['elapsed_ms']} ms, {result['cpu_ms']} ms CPU, "
+                  f"{result['logical_reads']} logical reads, {result['row_count']} rows")
+    measure_cursor.close()
+    conn_measure.close()
+    return run_id
+
+
+def grew(before, after, minimum=0):
+    """
+    Tells whether a measurement grew by more than REGRESSION_THRESHOLD.
+    Args:
+        before (float): The baseline value.
+        after (float): The new value.
+        minimum (float): Values below this are never flagged.
+    Returns:
+        bool: True when the measurement regressed.
+    """
+    if before is None or after is None or after < minimum:
+        return False
+    return after > before * (1 + REGRESSION_THRESHOLD)
+
+
+def compare_runs(cursor_dwh, baseline_run, candidate_run):
+    """
+    Compares two benchmark runs query by query and flags the regressions: more logical reads,
+    more CPU time or a costlier plan than the baseline, or a query that started failing.
+    Queries are matched on the hash of their text, so edited queries are not compared.
+    Args:
+        cursor_dwh (pyodbc.Cursor): The cursor object for the 'catchem_dwh' database.
+        baseline_run (int): The run_id before the change.
+        candidate_run (int): The run_id after the change.
+    Returns:
+        list: The names of the regressed queries.
+    """
+    cursor_dwh.execute("""
+        SELECT b.query_name, b.elapsed_ms, c.elapsed_ms, b.cpu_ms, c.cpu_ms, b.logical_reads, c.logical_reads,
+               b.plan_cost, c.plan_cost, b.plan_hash, c.plan_hash, b.error, c.error
+        FROM query_benchmark_result b
+        JOIN query_benchmark_result c ON c.query_hash = b.query_hash AND c.run_id = ?
+        WHERE b.run_id = ?
+        ORDER BY b.query_no
+    """, (candidate_run, baseline_run))
+
+    regressions = []
+    print(f"{'query':<60} {'elapsed ms':>17} {'CPU ms':>15} {'logical reads':>23} plan")
+    for (name, elapsed_b, elapsed_c, cpu_b, cpu_c, reads_b, reads_c,
+         cost_b, cost_c, plan_b, plan_c, error_b, error_c) in cursor_dwh.fetchall():
+        regressed = (error_c is not None and error_b is None) \
+            or grew(reads_b, reads_c) \
+            or grew(cpu_b, cpu_c, MIN_FLAGGED_MS) \
+            or grew(cost_b, cost_c)
+        plan = "same" if plan_b == plan_c else "changed"
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name[:60]:<60} {elapsed_b!s:>7} -> {elapsed_c!s:<7} {cpu_b!s:>5} -> {cpu_c!s:<7} "
+              f"{reads_b!s:>10} -> {reads_c!s:<10} {plan}{flag}")
+        if regressed:
+            regressions.append(name)
+    print(f"{len(regressions)} regressed queries")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the queries in queries.sql")
+    parser.add_argument('--label', help="what this run measures, e.g. 'before indexed view'")
+    parser.add_argument('--repeat', type=int, default=3, help="executions per query, the fastest is kept")
+    parser.add_argument('--compare', nargs=2, type=int, metavar=('BASELINE_RUN', 'CANDIDATE_RUN'),
+                        help="compare two stored runs instead of running the queries")
+    args = parser.parse_args()
+
+    try:
+        conn_dwh = establish_connection(SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER)
+        cursor_dwh = conn_dwh.cursor()
+
+        if args.compare:
+            compare_runs(cursor_dwh, *args.compare)
+        else:
+            run_id = run_benchmark(cursor_dwh, args.label, args.repeat)
+            print(f"Stored benchmark run {run_id}")
+
+        cursor_dwh.close()
+        conn_dwh.close()
+    except pyodbc.Error as e:
+        print(f"Error running the benchmark: {e}")
+
+
+if __name__ == "__main__":
+    main()
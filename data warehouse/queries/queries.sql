@@ -1,3 +1,6 @@
+-- The S1/S2 questions below are also answered from incrementally refreshed aggregate tables,
+-- without scanning factTreasureFound: see aggregates.QUESTIONS in data warehouse/fact/aggregates.py
+
 -- S1 queries
 
 --  On average, are fewer caches searched in more difficult terrain when it rains?
@@ -124,6 +127,34 @@ ORDER BY
 -- with variations observed across different days, higher counts on weekdays, fluctuations across months, particularly in September, and increased activity during the Autumn season.
 
 
+-- At what time of day are caches found? (dimHour, keyed by the hour of the day)
+SELECT
+    dh.DayPart,
+    dh.HourLabel,
+    COUNT(ftf.TreasureFoundID) AS total_caches_searched
+FROM
+    catchem_dwh.dbo.factTreasureFound ftf
+        JOIN
+    catchem_dwh.dbo.dimHour dh ON ftf.DIM_HOUR_SK = dh.hour_SK
+GROUP BY
+    dh.DayPart, dh.HourLabel
+ORDER BY
+    dh.HourLabel;
+
+-- day_SK is a yyyymmdd key, so a date range filters the fact table directly without joining dimDay
+SELECT
+    ftf.DIM_DAY_SK,
+    COUNT(ftf.TreasureFoundID) AS total_caches_searched
+FROM
+    catchem_dwh.dbo.factTreasureFound ftf
+WHERE
+    ftf.DIM_DAY_SK BETWEEN 20230901 AND 20230930
+GROUP BY
+    ftf.DIM_DAY_SK
+ORDER BY
+    ftf.DIM_DAY_SK;
+
+
 --(william) TODO:[S2] How does the type of user affect the duration of the treasure hunt? Does a starter take longer?
 SELECT
     u.experience_level,
@@ -14,6 +14,59 @@ def fetch_min_order_date(cursor_op):
     cursor_op.execute('SELECT MIN(Order_date) FROM tutorial_op.dbo.sales')
     return cursor_op.fetchone()[0]
 
+def create_table_dim_date(cursor_dwh, table_name='dimDay'):
+    """
+    Creates the 'dimDay' table if it doesn't exist. Date_SK is the yyyymmdd smart key; a table
+    of the old layout, with an IDENTITY Date_SK, is dropped and recreated.
+    Args:
+        cursor_dwh: The cursor object for the 'tutorial_dwh' database.
+        table_name (str): The name of the table (default is 'dimDay').
+    """
+    cursor_dwh.execute(f"""
+    IF COLUMNPROPERTY(OBJECT_ID('tutorial_dwh.dbo.{table_name}'), 'Date_SK', 'IsIdentity') = 1
+        DROP TABLE tutorial_dwh.dbo.{table_name}
+
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '{table_name}')
+    BEGIN
+        CREATE TABLE tutorial_dwh.dbo.{table_name} (
+            [Date_SK] INT NOT NULL PRIMARY KEY,
+            [Date] DATE NOT NULL UNIQUE,
+            [DayOfMonth] INT,
+            [Month] INT,
+            [Year] INT,
+            [DayOfWeek] INT,
+            [DayOfYear] INT,
+            [Weekday] NVARCHAR(10),
+            [MonthName] NVARCHAR(20),
+            [Quarter] INT
+        )
+    END
+    """)
+    cursor_dwh.commit()
+
+def build_calendar(start_date, end_date):
+    """
+    Builds the date-related attributes for every day between two dates as whole columns.
+    Args:
+        start_date (str): The first date of the calendar.
+        end_date (str): The last date of the calendar (inclusive).
+    Returns:
+        pd.DataFrame: One row per day, with the columns of the 'dimDay' table.
+    """
+    dates = pd.date_range(pd.to_datetime(start_date).normalize(), pd.to_datetime(end_date).normalize(), freq='D')
+    return pd.DataFrame({
+        'Date_SK': dwh.date_key(dates),
+        'Date': dates.date,
+        'DayOfMonth': dates.day,
+        'Month': dates.month,
+        'Year': dates.year,
+        'DayOfWeek': dates.dayofweek,
+        'DayOfYear': dates.dayofyear,
+        'Weekday': dates.day_name(),
+        'MonthName': dates.month_name(),
+        'Quarter': dates.quarter,
+    })
+
 def fill_table_dim_date(cursor_dwh, start_date, end_date='2040-01-01', table_name='dimDay'):
     """
     Fills the 'dimDay' table with date-related data.
@@ -23,30 +76,11 @@ def fill_table_dim_date(cursor_dwh, start_date, end_date='2040-01-01', table_nam
         end_date (str): The end date for filling the table (default is '2040-01-01').
         table_name (str): The name of the table (default is 'dimDay').
     """
-    insert_query = f"""
-    INSERT INTO tutorial_dwh.dbo.{table_name} ([Date], [DayOfMonth], [Month], [Year], [DayOfWeek], [DayOfYear], [Weekday], [MonthName], [Quarter])
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """
-    current_date = pd.to_datetime(start_date)
-    end_date = pd.to_datetime(end_date)
-    while current_date <= end_date:
-        day_of_month = current_date.day
-        month = current_date.month
-        year = current_date.year
-        day_of_week = current_date.dayofweek
-        day_of_year = current_date.timetuple().tm_yday
-        weekday = current_date.strftime('%A')
-        month_name = current_date.strftime('%B')
-        quarter = (current_date.month - 1) // 3 + 1  # Calculate quarter based on the month
-
-        # Execute the INSERT query
-        cursor_dwh.execute(insert_query, (
-            current_date, day_of_month, month, year, day_of_week, day_of_year, weekday, month_name, quarter
-        ))
+    calendar = build_calendar(start_date, end_date)
 
-        # Commit the transaction
-        cursor_dwh.commit()
-        current_date += pd.Timedelta(days=1)
+    # Send the days in large parameter arrays and commit once at the end
+    with dwh.BulkWriter(cursor_dwh, f'tutorial_dwh.dbo.{table_name}', calendar.columns) as writer:
+        writer.write_frame(calendar)
 
 def main():
     try:
@@ -63,7 +97,8 @@ def main():
         start_date = fetch_min_order_date(cursor_op)
         print(start_date)
 
-        # Fill the 'dimDay' table
+        # Create and fill the 'dimDay' table
+        create_table_dim_date(cursor_dwh, 'dimDay')
         fill_table_dim_date(cursor_dwh, start_date, '2100-01-01', 'dimDay')
 
         # Close the connections
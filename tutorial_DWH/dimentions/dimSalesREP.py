@@ -15,37 +15,51 @@ cursor_dwh = conn_dwh.cursor()
 
 # Define SQL query to fetch data from the source table
 select_query = """SELECT salesRepID, name, office FROM salesrep"""
-cursor_op.execute(select_query)
 
-# Loop through the rows fetched from the source table
-for sales_rep_id, name, office_op in cursor_op.fetchall():
-    # Execute query to get office and scd_version from dimSalesREP
-    cursor_dwh.execute("SELECT office, scd_version FROM dimSalesREP WHERE salesRepID = ? AND scd_active = 1",
-                       sales_rep_id)
-    rows = cursor_dwh.fetchall()
+# Attributes whose change opens a new dimSalesREP version; their hash is stored in row_hash
+SCD_TRACKED_COLUMNS = ['office']
 
-    if not rows:
-        # Insert a new record into dimSalesREP if no record exists for the salesRepID
-        insert_query = """INSERT INTO dimSalesREP (salesRepId, name, office, scd_start, scd_end, scd_version, scd_active)
-                          VALUES (?, ?, ?, ?, ?, ?, ?)"""
-        cursor_dwh.execute(insert_query, (sales_rep_id, name, office_op, datetime.datetime.now(), '2040-01-01', 1, 1))
-    else:
-        office_latest, scd_version_latest = max(rows, key=lambda x: x[1])
+# Tables created before row_hash existed get the column added
+cursor_dwh.execute("""
+    IF COL_LENGTH('dimSalesREP', 'row_hash') IS NULL
+        ALTER TABLE dimSalesREP ADD row_hash BINARY(8);
+""")
+cursor_dwh.commit()
 
-        if office_op != office_latest:
-            # Update the SCD attributes of the latest version
-            update_query = """UPDATE dimSalesREP SET scd_end = ?, scd_version = ?, scd_active = ?
-                              WHERE salesRepId = ? AND scd_active = 1"""
-            cursor_dwh.execute(update_query, (datetime.datetime.now(), scd_version_latest, 0, sales_rep_id))
+# Load the hash and version of every active version once; versions without a hash get it from office
+active_versions = {}
+for versions in dwh.iter_frames(cursor_dwh, """SELECT salesRepId, office, scd_version, row_hash
+                                               FROM dimSalesREP WHERE scd_active = 1"""):
+    missing = versions['row_hash'].isna()
+    if missing.any():
+        versions.loc[missing, 'row_hash'] = dwh.row_hash(versions[missing], SCD_TRACKED_COLUMNS)
+    for sales_rep_id, hash_value, scd_version in zip(versions['salesRepId'], versions['row_hash'], versions['scd_version']):
+        active_versions[sales_rep_id] = (bytes(hash_value), scd_version)
 
-            # Insert a new record into dimSalesREP with a new version
-            insert_query = """INSERT INTO dimSalesREP (salesRepId, name, office, scd_start, scd_end, scd_version, scd_active)
-                              VALUES (?, ?, ?, ?, ?, ?, ?)"""
-            cursor_dwh.execute(insert_query, (
-            sales_rep_id, name, office_op, datetime.datetime.now(), '2040-01-01', scd_version_latest + 1, 1))
+# New sales reps and new versions are buffered and bulk inserted, committed once at the end
+with dwh.BulkWriter(cursor_dwh, 'dimSalesREP', ['salesRepId', 'name', 'office', 'scd_start', 'scd_end', 'scd_version',
+                                                'scd_active', 'row_hash'],
+                    label='dimSalesREP') as new_versions:
+    # Loop through the rows fetched from the source table, in bounded batches
+    for batch in dwh.iter_frames(cursor_op, select_query, columns=['salesRepID', 'name', 'office']):
+        batch['row_hash'] = dwh.row_hash(batch, SCD_TRACKED_COLUMNS)
+        for sales_rep_id, name, office_op, hash_op in zip(batch['salesRepID'], batch['name'], batch['office'],
+                                                          batch['row_hash']):
+            if sales_rep_id not in active_versions:
+                # Insert a new record into dimSalesREP if no record exists for the salesRepID
+                new_versions.add((sales_rep_id, name, office_op, datetime.datetime.now(), '2040-01-01', 1, 1, hash_op))
+            else:
+                hash_latest, scd_version_latest = active_versions[sales_rep_id]
 
-    # Commit the transaction for each row
-    conn_dwh.commit()
+                if hash_op != hash_latest:
+                    # Update the SCD attributes of the latest version
+                    update_query = """UPDATE dimSalesREP SET scd_end = ?, scd_version = ?, scd_active = ?
+                                      WHERE salesRepId = ? AND scd_active = 1"""
+                    cursor_dwh.execute(update_query, (datetime.datetime.now(), int(scd_version_latest), 0, sales_rep_id))
+
+                    # Insert a new record into dimSalesREP with a new version
+                    new_versions.add((sales_rep_id, name, office_op, datetime.datetime.now(), '2040-01-01',
+                                      int(scd_version_latest) + 1, 1, hash_op))
 
 # Close the cursors and connections
 cursor_op.close()
@@ -1,7 +1,26 @@
+import decimal
+import hashlib
+import logging
+import math
+import numbers
+import time
+
 import config
+import pandas as pd
 import pyodbc
 from config import SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER
 
+logger = logging.getLogger(__name__)
+
+# Number of rows fetched per round-trip by the chunked extractors
+FETCH_SIZE = 10000
+
+# Number of rows sent per executemany call by BulkWriter
+BULK_BATCH_SIZE = 10000
+
+# Above this many keys load_key_set returns a Bloom filter instead of an exact set
+MAX_EXACT_KEYS = 5_000_000
+
 def establish_connection(server=SERVER, database=DATABASE_OP, username=USERNAME, password=PASSWORD,driver=DRIVER):
     """
     Establishes a connection to the specified SQL Server database.
@@ -15,4 +34,335 @@ def establish_connection(server=SERVER, database=DATABASE_OP, username=USERNAME,
         pyodbc.Connection: The connection object.
     """
     connection_string = f"DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}"
-    return pyodbc.connect(connection_string)
\ No newline at end of file
+    return pyodbc.connect(connection_string)
+
+
+def iter_batches(cursor, query, params=(), arraysize=FETCH_SIZE):
+    """
+    Runs a query and yields its rows in bounded batches using fetchmany, so the full
+    result set is never held in memory at once.
+    Args:
+        cursor (pyodbc.Cursor): The cursor to run the query on.
+        query (str): The SQL query.
+        params (tuple): The query parameters.
+        arraysize (int): The number of rows per batch.
+    Yields:
+        list: A batch of at most arraysize rows, as tuples.
+    """
+    cursor.arraysize = arraysize
+    cursor.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            break
+        yield [tuple(row) for row in rows]
+
+
+def iter_frames(cursor, query, params=(), arraysize=FETCH_SIZE, columns=None):
+    """
+    Runs a query and yields its rows as DataFrames of at most arraysize rows.
+    Args:
+        cursor (pyodbc.Cursor): The cursor to run the query on.
+        query (str): The SQL query.
+        params (tuple): The query parameters.
+        arraysize (int): The number of rows per DataFrame.
+        columns (list, optional): The column names, taken from the result set when omitted.
+    Yields:
+        pd.DataFrame: A chunk of the result set.
+    """
+    for rows in iter_batches(cursor, query, params, arraysize):
+        if columns is None:
+            columns = [column[0] for column in cursor.description]
+        yield pd.DataFrame(rows, columns=columns)
+
+def frame_rows(frame, columns=None):
+    """
+    Converts DataFrame rows into tuples of plain Python values that pyodbc can bind,
+    with missing values (NaN/NaT) as None.
+    Args:
+        frame (pd.DataFrame): The rows to convert.
+        columns (list, optional): The columns to take, in order (default is all columns).
+    Returns:
+        list: One tuple per row.
+    """
+    columns = list(frame.columns) if columns is None else columns
+    values = [frame[column].astype(object).where(frame[column].notna(), None).tolist() for column in columns]
+    return list(zip(*values))
+
+
+def row_hash(frame, columns):
+    """
+    Computes a fixed-width 8-byte hash of the given columns for every row, vectorized.
+    Missing values hash like empty strings and every value is hashed as its text, so the
+    hash of a source extract matches the hash of the same values read back from the warehouse.
+    Store it in a BINARY(8) column; SCD change detection is then one comparison per key.
+    Args:
+        frame (pd.DataFrame): The rows to hash.
+        columns (list): The tracked columns, in a fixed order.
+    Returns:
+        pd.Series: The hashes as bytes, aligned with the frame's index.
+    """
+    values = frame[columns].astype(object)
+    values = values.where(values.notna(), '').astype(str)
+    raw = pd.util.hash_pandas_object(values, index=False).to_numpy().astype('>u8').tobytes()
+    return pd.Series([raw[i:i + 8] for i in range(0, len(raw), 8)], index=frame.index, dtype=object)
+
+
+def common_key_dtype(left, right):
+    """
+    Picks one dtype both join key columns can be cast to: int64 when both hold integers,
+    float64 when both are numeric and object (compared by value) otherwise.
+    Args:
+        left (pd.Series): The key column of one side.
+        right (pd.Series): The key column of the other side.
+    Returns:
+        str: The dtype to cast both columns to.
+    """
+    types = pd.api.types
+    if types.is_integer_dtype(left) and types.is_integer_dtype(right):
+        return 'int64'
+    if types.is_numeric_dtype(left) and types.is_numeric_dtype(right) \
+            and not types.is_bool_dtype(left) and not types.is_bool_dtype(right):
+        return 'float64'
+    return 'object'
+
+
+def resolve_scd_keys(facts, versions, natural_key, moment, surrogate_key,
+                     start='scd_start', end='scd_end', clamp_to_first=True):
+    """
+    Resolves the surrogate key of the SCD Type 2 version that was valid at each fact's moment,
+    with one sorted as-of join (pd.merge_asof) over all versions instead of a lookup per fact.
+    A version is valid from its start up to, but not including, its end.
+    Args:
+        facts (pd.DataFrame): The facts, with the natural key and the moment columns.
+        versions (pd.DataFrame): All versions of the dimension, with the natural key, start, end
+            and surrogate key columns (load them once per run).
+        natural_key (str): The name of the natural key column in both frames.
+        moment (str): The timestamp column of the facts.
+        surrogate_key (str): The surrogate key column of the versions.
+        start (str): The column with the start of a version.
+        end (str): The column with the end of a version.
+        clamp_to_first (bool): Resolve facts older than the first version of their key to that
+            first version, for dimensions whose first version starts at its load time.
+    Returns:
+        pd.Series: The surrogate keys aligned with the facts' index, NaN where no version matches.
+    """
+    if facts.empty or versions.empty:
+        return pd.Series(float('nan'), index=facts.index, dtype=float)
+
+    # merge_asof only joins identical key and time dtypes: date columns can come out as
+    # datetime64[s] while datetimes are [us], and an int key may meet an object one
+    left = pd.DataFrame({natural_key: facts[natural_key].to_numpy(),
+                         moment: pd.to_datetime(facts[moment]).astype('datetime64[ns]').to_numpy(),
+                         '_row': range(len(facts))})
+    left = left[left[moment].notna()].sort_values(moment, kind='mergesort')
+
+    right = versions[[natural_key, start, end, surrogate_key]].copy()
+    right[start] = pd.to_datetime(right[start]).astype('datetime64[ns]')
+    right[end] = pd.to_datetime(right[end]).astype('datetime64[ns]')
+    right = right[right[start].notna()].sort_values(start, kind='mergesort')
+
+    key_dtype = common_key_dtype(left[natural_key], right[natural_key])
+    left[natural_key] = left[natural_key].astype(key_dtype)
+    right[natural_key] = right[natural_key].astype(key_dtype)
+
+    matched = pd.merge_asof(left, right, left_on=moment, right_on=start, by=natural_key, direction='backward')
+    # A version that ended before the moment (no later version exists) doesn't match
+    expired = matched[end].notna() & (matched[moment] >= matched[end])
+    matched.loc[expired, surrogate_key] = None
+
+    if clamp_to_first:
+        first_versions = right.drop_duplicates(subset=natural_key, keep='first').set_index(natural_key)[surrogate_key]
+        before_first = matched[start].isna()
+        matched.loc[before_first, surrogate_key] = matched.loc[before_first, natural_key].map(first_versions)
+
+    keys = pd.Series(float('nan'), index=range(len(facts)), dtype=object)
+    keys.loc[matched['_row'].to_numpy()] = matched[surrogate_key].to_numpy()
+    keys.index = facts.index
+    return pd.to_numeric(keys)
+
+
+class BulkWriter:
+    """
+    Buffers rows for one table and sends them with pyodbc fast_executemany.
+
+    commit_every decides the commit policy: None commits once when the writer is closed,
+    a number commits after that many rows as well, and 0 never commits so the caller can
+    keep the rows in its own transaction. Closing the writer logs the rows/sec it reached
+    at DEBUG level.
+
+    Use it as a context manager; when the block raises, the buffered rows are dropped
+    and nothing is committed.
+    """
+
+    def __init__(self, cursor, table, columns, batch_size=BULK_BATCH_SIZE, commit_every=None, label=None):
+        """
+        Args:
+            cursor (pyodbc.Cursor): A cursor of the connection to write with.
+            table (str): The target table.
+            columns (list): The target columns, in the order of the row tuples.
+            batch_size (int): The number of rows per executemany call.
+            commit_every (int, optional): The commit policy, see the class docstring.
+            label (str, optional): The name used in the throughput report (default is the table name).
+        """
+        self.cursor = cursor.connection.cursor()
+        self.cursor.fast_executemany = True
+        self.table = table
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.label = label or table
+        self.rows = []
+        self.written = 0
+        self.uncommitted = 0
+        self.started = time.perf_counter()
+
+        column_list = ", ".join(f"[{column}]" for column in self.columns)
+        placeholders = ", ".join("?" for _ in self.columns)
+        self.insert_query = f"INSERT INTO {table} ({column_list}) VALUES ({placeholders})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.rows = []
+        return False
+
+    def add(self, row):
+        """
+        Buffers one row and sends the buffer when it is full.
+        Args:
+            row (tuple): The values, in the order of the writer's columns.
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def extend(self, rows):
+        """
+        Buffers several rows.
+        Args:
+            rows (iterable): Tuples of values, in the order of the writer's columns.
+        """
+        for row in rows:
+            self.add(row)
+
+    def write_frame(self, frame):
+        """
+        Buffers the rows of a DataFrame that has (at least) the writer's columns.
+        Args:
+            frame (pd.DataFrame): The rows to write.
+        """
+        self.extend(frame_rows(frame, self.columns))
+
+    def flush(self):
+        """Sends the buffered rows to the server and commits when the commit policy says so."""
+        if not self.rows:
+            return
+        self.cursor.executemany(self.insert_query, self.rows)
+
+        self.written += len(self.rows)
+        self.uncommitted += len(self.rows)
+        self.rows = []
+        if self.commit_every and self.uncommitted >= self.commit_every:
+            self.cursor.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        """
+        Sends the remaining rows, commits unless the caller owns the transaction and
+        logs the throughput.
+        Returns:
+            int: The number of rows written.
+        """
+        self.flush()
+        if self.commit_every != 0 and self.uncommitted:
+            self.cursor.commit()
+            self.uncommitted = 0
+        elapsed = time.perf_counter() - self.started
+        rate = self.written / elapsed if elapsed > 0 else 0
+        logger.debug(f"{self.label}: wrote {self.written} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+        return self.written
+
+
+def date_key(moment):
+    """
+    Computes the yyyymmdd smart key of the 'dimDay' row a date falls on.
+    Args:
+        moment: A date/datetime, or a pandas Series/DatetimeIndex of datetimes.
+    Returns:
+        int or pd.Series: The day key(s), e.g. 20230912.
+    """
+    parts = moment.dt if hasattr(moment, 'dt') else moment
+    return parts.year * 10000 + parts.month * 100 + parts.day
+
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set: membership tests never miss a key that was added,
+    but may report a key that wasn't (with probability error_rate).
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Args:
+            capacity (int): The number of keys the filter is sized for.
+            error_rate (float): The false positive rate at that capacity.
+        """
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @staticmethod
+    def _normalize(key):
+        """
+        Gives equal keys the same bytes whatever type the driver or pandas returned them as,
+        so 5, 5.0, numpy.int64(5) and Decimal('5') all hash alike.
+        """
+        if isinstance(key, (bytes, bytearray)):
+            return bytes(key)
+        if isinstance(key, (numbers.Real, decimal.Decimal)) and not isinstance(key, bool) \
+                and math.isfinite(key) and key == int(key):
+            return str(int(key)).encode()
+        return str(key).encode()
+
+    def _positions(self, key):
+        """Derives the bit positions of a key from one 128-bit hash (double hashing)."""
+        digest = hashlib.blake2b(self._normalize(key), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        """Adds a key to the filter."""
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        """Returns True when the key was probably added, False when it certainly wasn't."""
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+def load_key_set(cursor, table, column, max_exact=MAX_EXACT_KEYS):
+    """
+    Streams all values of a key column into memory once, as an exact set when they fit
+    under max_exact and as a Bloom filter otherwise.
+    Args:
+        cursor (pyodbc.Cursor): The cursor to run the queries on.
+        table (str): The table holding the keys.
+        column (str): The key column.
+        max_exact (int): The largest number of keys kept in an exact set.
+    Returns:
+        set or BloomFilter: The loaded keys; a BloomFilter hit still has to be confirmed.
+    """
+    cursor.execute(f"SELECT COUNT(*) FROM {table}")
+    count = cursor.fetchone()[0]
+    keys = set() if count <= max_exact else BloomFilter(count)
+    for rows in iter_batches(cursor, f"SELECT [{column}] FROM {table}"):
+        for (key,) in rows:
+            keys.add(key)
+    return keys
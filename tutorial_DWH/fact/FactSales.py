@@ -1,59 +1,108 @@
+import pandas as pd
 import pyodbc
 import dwh_tools as dwh
+from config import SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER
 
-try:
-    # Create connection strings
-    from config import SERVER, DATABASE_OP, DATABASE_DWH, USERNAME, PASSWORD, DRIVER
-    conn_op = dwh.establish_connection(SERVER, DATABASE_OP, USERNAME, PASSWORD, DRIVER)
-    conn_dwh = dwh.establish_connection(SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER)
+FACT_SALES_COLUMNS = ['SALES_ID', 'DIM_DATE_SK', 'DIM_SALESREP_SK', 'REVENUE_MV', 'COUNT_MV']
 
-    # Create cursors
-    cursor_op = conn_op.cursor()
-    cursor_dwh = conn_dwh.cursor()
+# SQL Server accepts at most 2100 parameters per statement
+CONFIRM_BATCH_SIZE = 1000
+
+
+def load_sales_rep_versions(cursor_dwh):
+    """
+    Reads every dimSalesRep version once, for the point-in-time resolution of DIM_SALESREP_SK.
+    Args:
+        cursor_dwh: The cursor object for the 'tutorial_dwh' database.
+    Returns:
+        pd.DataFrame: The SalesRepId, salesRepSK and validity interval of every version.
+    """
+    cursor_dwh.execute("SELECT salesRepID, salesRepSK, scd_start, scd_end FROM dimSalesRep")
+    return pd.DataFrame([tuple(row) for row in cursor_dwh.fetchall()],
+                        columns=['SalesRepId', 'salesRepSK', 'scd_start', 'scd_end'])
+
+
+def confirm_existing_sales_ids(cursor_dwh, candidates):
+    """
+    Checks which of the given SALES_IDs really are in FactSales. Only needed for the
+    hits of a Bloom filter, which may be false positives.
+    Args:
+        cursor_dwh: The cursor object for the 'tutorial_dwh' database.
+        candidates (list): The SALES_IDs to check.
+    Returns:
+        set: The SALES_IDs that exist in FactSales.
+    """
+    existing = set()
+    for offset in range(0, len(candidates), CONFIRM_BATCH_SIZE):
+        batch = candidates[offset:offset + CONFIRM_BATCH_SIZE]
+        placeholders = ", ".join("?" for _ in batch)
+        cursor_dwh.execute(f"SELECT [SALES_ID] FROM FactSales WHERE [SALES_ID] IN ({placeholders})", batch)
+        existing.update(row[0] for row in cursor_dwh.fetchall())
+    return existing
+
+
+def load_new_sales(cursor_op, cursor_dwh):
+    """
+    Loads the orders that are not in FactSales yet. Existing SALES_IDs and the sales rep versions
+    are read once, each chunk of orders is anti-joined against them in memory and only the
+    new orders are bulk inserted.
+    Args:
+        cursor_op: The cursor object for the 'tutorial_op' database.
+        cursor_dwh: The cursor object for the 'tutorial_dwh' database.
+    """
+    existing_ids = dwh.load_key_set(cursor_dwh, 'FactSales', 'SALES_ID')
+    exact = isinstance(existing_ids, set)
+    sales_rep_versions = load_sales_rep_versions(cursor_dwh)
 
-    # Fetch order data from sales
     Sales_query = "SELECT Order_Date, Customer_Name, SalesRepId, Amount, Order_ID FROM sales"
-    cursor_op.execute(Sales_query)
-    for row in cursor_op.fetchall():
-        Order_Date, Customer_Name, SalesRepId, Amount, Order_ID = row
-        # Check if the sales record already exists in the fact table
-        FactSales_query = "SELECT [SALES_ID] FROM FactSales WHERE [SALES_ID] = ?"
-        cursor_dwh.execute(FactSales_query, Order_ID)
-
-        if not cursor_dwh.fetchone():  # If the record doesn't exist, we want to only insert SK
-            # Fetch DIM_DATE_SK
-            dimDay_query = "SELECT Date_SK FROM dimDay WHERE DATE = ?"
-            cursor_dwh.execute(dimDay_query, Order_Date)
-            Date_SK = cursor_dwh.fetchone()
-            if Date_SK:
-                Date_SK = Date_SK[0]
-            else:
-                # Handle the case when Date_SK is not found
-                print(f"Error: Date_SK not found for date: {Order_Date}")
-                continue
-
-            # Fetch DIM_SALESREP_SK
-            SalesRep_query = "SELECT salesRepSK FROM dimSalesRep WHERE salesRepID = ? AND scd_active = 1"
-            cursor_dwh.execute(SalesRep_query, SalesRepId)
-            salesRepSK = cursor_dwh.fetchone()
-            if salesRepSK:
-                salesRepSK = salesRepSK[0]
-            else:
-                # Handle the case when salesRepSK is not found
-                print(f"Error: salesRepSK not found for salesRepID: {SalesRepId}")
-                continue
-
-            # Insert into FactSales
-            insert_query = """INSERT INTO [dbo].[FactSales] ([SALES_ID], [DIM_DATE_SK], [DIM_SALESREP_SK], [REVENUE_MV], [COUNT_MV])
-                                  VALUES (?, ?, ?, ?, ?)"""
-            cursor_dwh.execute(insert_query, (Order_ID, Date_SK, salesRepSK, Amount, 1))
-        conn_dwh.commit()
-    #close cursors
-    cursor_op.close()
-    cursor_dwh.close()
-    #close connections
-    conn_op.close()
-    conn_dwh.close()
-except pyodbc.Error as e:
-    print(f"Error connecting to the database: {e}")
+    # New orders are buffered and bulk inserted, committed once at the end
+    with dwh.BulkWriter(cursor_dwh, '[dbo].[FactSales]', FACT_SALES_COLUMNS, label='FactSales') as writer:
+        # Stream the orders in bounded batches instead of fetching them all at once
+        for orders in dwh.iter_frames(cursor_op, Sales_query):
+            known = orders['Order_ID'].map(existing_ids.__contains__).astype(bool)
+            if not exact and known.any():
+                confirmed = confirm_existing_sales_ids(cursor_dwh, orders.loc[known, 'Order_ID'].tolist())
+                known = orders['Order_ID'].isin(confirmed)
+            orders = orders[~known]
+
+            # DIM_DATE_SK is the yyyymmdd smart key of the order date, no lookup needed
+            orders = orders.assign(
+                DIM_DATE_SK=dwh.date_key(pd.to_datetime(orders['Order_Date'])),
+                # The sales rep version that was valid on the order date
+                DIM_SALESREP_SK=dwh.resolve_scd_keys(orders, sales_rep_versions, 'SalesRepId', 'Order_Date',
+                                                     'salesRepSK'),
+            )
+            missing_rep = orders['DIM_SALESREP_SK'].isna()
+            for sales_rep_id in orders.loc[missing_rep, 'SalesRepId'].unique():
+                print(f"Error: salesRepSK not found for salesRepID: {sales_rep_id}")
+            orders = orders[~missing_rep].rename(columns={'Order_ID': 'SALES_ID', 'Amount': 'REVENUE_MV'})
+            orders = orders.assign(DIM_SALESREP_SK=orders['DIM_SALESREP_SK'].astype(int), COUNT_MV=1)
+            writer.write_frame(orders)
+            for sales_id in orders['SALES_ID']:
+                existing_ids.add(sales_id)
+
+
+def main():
+    try:
+        # Create connections
+        conn_op = dwh.establish_connection(SERVER, DATABASE_OP, USERNAME, PASSWORD, DRIVER)
+        conn_dwh = dwh.establish_connection(SERVER, DATABASE_DWH, USERNAME, PASSWORD, DRIVER)
+
+        # Create cursors
+        cursor_op = conn_op.cursor()
+        cursor_dwh = conn_dwh.cursor()
+
+        load_new_sales(cursor_op, cursor_dwh)
+
+        #close cursors
+        cursor_op.close()
+        cursor_dwh.close()
+        #close connections
+        conn_op.close()
+        conn_dwh.close()
+    except pyodbc.Error as e:
+        print(f"Error connecting to the database: {e}")
+
 
+if __name__ == "__main__":
+    main()